@@ -1,15 +1,32 @@
 # Standard library modules
+import json
+import os
+from collections import OrderedDict
+from collections.abc import Hashable
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, DecimalException
+from logging import Logger
 from pathlib import Path
-from uuid import uuid4
+from threading import Lock
+from time import monotonic, perf_counter
 
 # Third party modules
-from argon2 import PasswordHasher
+from argon2 import PasswordHasher, low_level
 from argon2.exceptions import VerifyMismatchError
 
 # Local modules
-from src.db import User, UserDatabase
+from src.db import MAX_BALANCE, User, UserDatabase
 from src.utils import setup_logger, ErrorCode
 
+# Argon2 hashing is the most expensive operation of the Bank, the bindings
+# should be built from the optimized libargon2 sources (opt.c) instead of the
+# portable reference ones (ref.c), see the Dockerfile for the build flags.
+# Stored hashes are Argon2 v1.3, so refuse to run against an older library.
+if low_level.ARGON2_VERSION != 0x13:
+    raise ImportError(
+        f"Unsupported libargon2 version {low_level.ARGON2_VERSION:#x}, expected 0x13"
+    )
+
 # Globals
 OK = ErrorCode.OK
 INVALID_REGISTRATION = ErrorCode.INVALID_REGISTRATION
@@ -21,141 +38,559 @@ UUID_NOT_FOUND = ErrorCode.UUID_NOT_FOUND
 BAD_ARGUMENTS = ErrorCode.BAD_ARGUMENTS
 UNKNOWN_ERROR = ErrorCode.UNKNOWN_ERROR
 
+# Shared results for the replies without data, so they aren't rebuilt per call
+_R_OK = OK, ""
+_R_INVALID_REGISTRATION = INVALID_REGISTRATION, ""
+_R_INVALID_LOGIN = INVALID_LOGIN, ""
+_R_SESSION_CONFLICT = SESSION_CONFLICT, ""
+_R_INSUFFICIENT_FUNDS = INSUFFICIENT_FUNDS, ""
+_R_UUID_NOT_FOUND = UUID_NOT_FOUND, ""
+_R_BAD_ARGUMENTS = BAD_ARGUMENTS, ""
+
+# Argon2 calibration settings, memory costs are given in KiB
+ARGON2_TARGET_TIME = 0.25
+ARGON2_MIN_TIME_COST = 2
+ARGON2_MIN_MEMORY_COST = 19 * 1024
+ARGON2_MAX_MEMORY_COST = 256 * 1024
+
+# Biggest amount of cents that can be stored
+MAX_CENTS = MAX_BALANCE
+
+# Number of independently locked groups the connected users are split into
+SESSION_SHARDS = 16
+
+# Seconds a login lasts without a logout, and between sweeps of expired ones
+SESSION_TTL = 3600.0
+SESSION_SWEEP_INTERVAL = 60.0
+
+# Number of usernames whose login credentials are kept in memory
+LOGIN_INDEX_SIZE = 1024
+
+
+def to_cents(amount: str) -> int | None:
+    """
+    Parses an amount of money sent by a client into an integer number of cents.
+
+    Args:
+        amount (str): The amount to parse, e.g. "12.34".
+
+    Returns:
+        int | None: The amount in cents, or None if it isn't a valid non-negative
+        amount with at most two decimals.
+    """
+    # Besides malformed amounts, huge exponents (e.g. "1e999999") overflow the
+    # decimal context when scaled
+    try:
+        cents = Decimal(amount).scaleb(2)
+    except DecimalException:
+        return None
+
+    if not cents.is_finite() or cents < 0 or cents != cents.to_integral_value():
+        return None
+
+    # SQLite integers are signed 64 bits
+    if cents > MAX_CENTS:
+        return None
+    return int(cents)
+
+
+def format_cents(cents: int) -> str:
+    """
+    Formats an integer number of cents as an amount of money, e.g. "12.34".
+
+    Args:
+        cents (int): The amount in cents.
+
+    Returns:
+        str: The formatted amount.
+    """
+    return str(Decimal(cents).scaleb(-2))
+
+
+def calibrate_hasher(
+    target_time: float = ARGON2_TARGET_TIME, parallelism: int | None = None
+) -> PasswordHasher:
+    """
+    Finds the Argon2 cost parameters that make a single hash take at least
+    target_time seconds on the current host.
+
+    The memory cost is doubled first, as it is the parameter that hurts
+    attackers the most, once it reaches ARGON2_MAX_MEMORY_COST the time cost
+    is increased instead.
+
+    Args:
+        target_time (float): The desired hashing time in seconds.
+        parallelism (int | None): The number of lanes, defaults to half the CPU
+        count, leaving cores for the hashes of other connected clients.
+
+    Returns:
+        PasswordHasher: A hasher configured with the calibrated parameters.
+    """
+    parallelism = parallelism or max(1, (os.cpu_count() or 1) // 2)
+    time_cost = ARGON2_MIN_TIME_COST
+    memory_cost = ARGON2_MIN_MEMORY_COST
+
+    while True:
+        hasher = PasswordHasher(
+            time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism
+        )
+        start = perf_counter()
+        hasher.hash("calibration")
+        if perf_counter() - start >= target_time:
+            return hasher
+
+        if memory_cost < ARGON2_MAX_MEMORY_COST:
+            memory_cost = min(memory_cost * 2, ARGON2_MAX_MEMORY_COST)
+        else:
+            time_cost += 1
+
+
+def load_hasher(path: Path, logger: Logger | None = None) -> PasswordHasher:
+    """
+    Loads the calibrated Argon2 parameters stored in path, calibrating and
+    storing them if the file doesn't exist or can't be parsed.
+
+    Args:
+        path (Path): The path to the JSON file with the parameters.
+        logger (Logger | None): Optional logger for the calibration events.
+
+    Returns:
+        PasswordHasher: A hasher configured with the stored parameters.
+    """
+    try:
+        parameters = json.loads(path.read_text())
+        return PasswordHasher(
+            time_cost=parameters["time_cost"],
+            memory_cost=parameters["memory_cost"],
+            parallelism=parameters["parallelism"],
+        )
+
+    except (OSError, ValueError, KeyError, TypeError):
+        if logger is not None:
+            logger.info("Calibrating Argon2 parameters, please wait...")
+
+    hasher = calibrate_hasher()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(
+        json.dumps(
+            {
+                "time_cost": hasher.time_cost,
+                "memory_cost": hasher.memory_cost,
+                "parallelism": hasher.parallelism,
+            }
+        )
+    )
+    return hasher
+
+
+def hashing_workers(hasher: PasswordHasher, jobs: int) -> int:
+    """
+    Finds how many passwords can be hashed at once without oversubscribing
+    the CPU. Every hash already runs one thread per lane and takes memory_cost
+    KiB, so the workers are limited to the CPUs left for each hash's lanes.
+
+    Args:
+        hasher (PasswordHasher): The hasher the passwords are hashed with.
+        jobs (int): The number of passwords to hash.
+
+    Returns:
+        int: The number of hashes to run in parallel.
+    """
+    workers = max(1, (os.cpu_count() or 1) // hasher.parallelism)
+    return max(1, min(jobs, workers))
+
 
 class Bank:
-    def __init__(self, dbpath: Path, verbose: bool = False):
+    def __init__(
+        self,
+        dbpath: str | Path,
+        verbose: bool = False,
+        session_ttl: float = SESSION_TTL,
+        hasher: PasswordHasher | None = None,
+    ):
         self.logger = setup_logger(name="bank", verbose=verbose)
         self.logger.debug("Instantiating new Bank")
 
         self.__database = UserDatabase(dbpath=dbpath, verbose=verbose)
-        self.__connected_users = set()
+        # Uses the calibrated parameters unless a hasher is given (e.g. tests)
+        self.__hasher = hasher or load_hasher(
+            Path(dbpath).parent / "argon2.json", self.logger
+        )
+        self.logger.info(
+            "Argon2 parameters: time_cost = %d, memory_cost = %d KiB, parallelism = %d",
+            self.__hasher.time_cost,
+            self.__hasher.memory_cost,
+            self.__hasher.parallelism,
+        )
+
+        # Hash verified on logins of unknown users, so they take as long as
+        # the ones of registered users and don't leak which usernames exist
+        self.__dummy_hash = self.__hasher.hash(os.urandom(16).hex())
+        # Connected users, mapping each UUID to the time its session expires
+        # and the owner given on login (e.g. the connection that logged in)
+        self.__session_ttl = session_ttl
+        self.__next_session_sweep = monotonic() + SESSION_SWEEP_INTERVAL
+        self.__session_shards: list[tuple[dict[str, tuple[float, Hashable]], Lock]] = [
+            ({}, Lock()) for _ in range(SESSION_SHARDS)
+        ]
+
+        # Credentials of the most recent logins, as (uuid, hash) tuples indexed
+        # by username. Every password change of this Bank drops them and bumps
+        # the generation, so logins that read a hash before the change can't
+        # index it afterwards
+        self.__login_index: OrderedDict[str, tuple[str, str]] = OrderedDict()
+        self.__login_index_generation = 0
+        self.__login_index_lock = Lock()
 
     def get_db(self) -> UserDatabase:
         return self.__database
 
     def register(self, username: str = "", password: str = "") -> tuple[ErrorCode, str]:
-        self.logger.debug(
-            f"Registering new user with username = {username}, password = {password}"
-        )
+        self.logger.debug("Registering new user with username = %s", username)
 
         # Check empty fields
-        if username == "" or password == "":
-            return BAD_ARGUMENTS, ""
+        if not username or not password:
+            return _R_BAD_ARGUMENTS
 
         # User is already registered
-        user_data = self.__database.read(username=username)
+        user_data = self.__database.read_by_username(username)
         if user_data is not None:
-            return INVALID_REGISTRATION, ""
+            return _R_INVALID_REGISTRATION
 
-        # Perform registration
-        self.__database.create(
+        # Perform registration, the username may have been taken meanwhile
+        created = self.__database.create(
             User(
-                uuid=uuid4().hex,
+                uuid=os.urandom(16).hex(),
                 username=username,
-                password=PasswordHasher().hash(password),
+                password=self.__hasher.hash(password),
             )
         )
-        return OK, ""
+        if not created:
+            return _R_INVALID_REGISTRATION
+        return _R_OK
 
-    def logout(self, uuid: str = "") -> tuple[ErrorCode, str]:
-        self.logger.debug(f"Logging out user with uuid = {uuid}")
+    def register_many(
+        self, credentials: list[tuple[str, str]]
+    ) -> list[tuple[ErrorCode, str]]:
+        """
+        Registers several users at once, hashing every password with the same
+        hasher and inserting all the new users in a single transaction.
+
+        Args:
+            credentials (list[tuple[str, str]]): The (username, password) pairs.
+
+        Returns:
+            list[tuple[ErrorCode, str]]: The result of each registration, in order,
+            with the UUID of every registered user as its data.
+        """
+        self.logger.debug("Registering %d new users", len(credentials))
+
+        results = []
+        pending = []
+        usernames = set()
+        for username, password in credentials:
+            # Check empty fields
+            if not username or not password:
+                results.append(_R_BAD_ARGUMENTS)
+                continue
+
+            # User is already registered, or repeated in this batch
+            if (
+                username in usernames
+                or self.__database.read_by_username(username) is not None
+            ):
+                results.append(_R_INVALID_REGISTRATION)
+                continue
+
+            usernames.add(username)
+            pending.append((len(results), username, password))
+            results.append(_R_OK)
+
+        # Perform registration, libargon2 releases the GIL so the passwords
+        # are hashed in parallel
+        if pending:
+            workers = hashing_workers(self.__hasher, len(pending))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                hashes = executor.map(
+                    self.__hasher.hash, [password for _, _, password in pending]
+                )
+                users = [
+                    User(uuid=os.urandom(16).hex(), username=username, password=hash)
+                    for (_, username, _), hash in zip(pending, hashes)
+                ]
+            inserted = self.__database.create_many(users)
+
+            # Usernames taken by concurrent registrations weren't inserted
+            for (index, _, _), user, created in zip(pending, users, inserted):
+                results[index] = (OK, user.uuid) if created else _R_INVALID_REGISTRATION
+        return results
+
+    def logout(self, uuid: str = "", owner: Hashable = None) -> tuple[ErrorCode, str]:
+        self.logger.debug("Logging out user with uuid = %s", uuid)
 
         # Check empty fields
-        if uuid == "":
-            return BAD_ARGUMENTS, ""
+        if not uuid:
+            return _R_BAD_ARGUMENTS
 
-        # UUID not logged in
-        if uuid not in self.__connected_users:
-            return UUID_NOT_FOUND, ""
+        # Only the owner of the session can end it, so a connection whose
+        # session expired can't end the one of a later login
+        connected_users, lock = self.__session_shard(uuid)
+        with lock:
+            session = connected_users.get(uuid)
+            if session is None or session[1] != owner:
+                return _R_UUID_NOT_FOUND
+            del connected_users[uuid]
 
-        self.__connected_users.remove(uuid)
-        return OK, ""
+        # Its session already expired
+        if session[0] <= monotonic():
+            return _R_UUID_NOT_FOUND
 
-    def login(self, username: str = "", password: str = "") -> tuple[ErrorCode, str]:
-        self.logger.debug(
-            f"Logging in user with username = {username} and password = {password}"
-        )
+        return _R_OK
 
-        # Check empty fields
-        if username == "" or password == "":
-            return BAD_ARGUMENTS, ""
+    def touch(self, uuid: str, owner: Hashable = None) -> bool:
+        """
+        Extends the session of a user by the session time to live, so clients
+        that keep sending commands stay logged in.
 
-        # User is not registered
-        user_data = self.__database.read(username=username)
-        if user_data is None:
-            return INVALID_LOGIN, ""
+        Args:
+            uuid (str): The UUID of the user.
+            owner (Hashable): The owner given when the session was created.
+
+        Returns:
+            bool: True if the session was extended, False if it expired or
+            belongs to another owner.
+        """
+        now = monotonic()
+        connected_users, lock = self.__session_shard(uuid)
+        with lock:
+            session = connected_users.get(uuid)
+            if session is None or session[1] != owner or session[0] <= now:
+                return False
+            connected_users[uuid] = now + self.__session_ttl, owner
+        return True
+
+    def __session_shard(
+        self, uuid: str
+    ) -> tuple[dict[str, tuple[float, Hashable]], Lock]:
+        """
+        Finds the group of connected users a UUID belongs to, so only that
+        group has to be locked when logging in or out.
+
+        Args:
+            uuid (str): The UUID of the user.
 
+        Returns:
+            tuple[dict[str, tuple[float, Hashable]], Lock]: The connected users of
+            the group and its lock.
+        """
+        return self.__session_shards[hash(uuid) % SESSION_SHARDS]
+
+    def __sweep_sessions(self, now: float):
+        """
+        Removes the expired sessions of every group, at most once every
+        SESSION_SWEEP_INTERVAL seconds, so clients that never logged out
+        don't hold memory forever.
+
+        Args:
+            now (float): The current monotonic time.
+        """
+        if now < self.__next_session_sweep:
+            return
+        self.__next_session_sweep = now + SESSION_SWEEP_INTERVAL
+
+        for connected_users, lock in self.__session_shards:
+            with lock:
+                expired = [
+                    uuid
+                    for uuid, (expiration, _) in connected_users.items()
+                    if expiration <= now
+                ]
+                for uuid in expired:
+                    del connected_users[uuid]
+
+    def __indexed_credentials(
+        self, username: str
+    ) -> tuple[tuple[str, str] | None, int]:
+        """
+        Looks up the login credentials of a username in the index.
+
+        Args:
+            username (str): The username of the user.
+
+        Returns:
+            tuple[tuple[str, str] | None, int]: The (uuid, hash) of the user, or
+            None if it isn't indexed, and the generation of the index.
+        """
+        with self.__login_index_lock:
+            credentials = self.__login_index.get(username)
+            if credentials is not None:
+                self.__login_index.move_to_end(username)
+            return credentials, self.__login_index_generation
+
+    def __index_credentials(
+        self, username: str, credentials: tuple[str, str], generation: int
+    ):
+        """
+        Stores the login credentials of a username in the index, dropping the
+        least recently used ones when it is full. Nothing is stored if a
+        password changed since the credentials were read, as they may be stale.
+
+        Args:
+            username (str): The username of the user.
+            credentials (tuple[str, str]): The (uuid, hash) of the user.
+            generation (int): The generation of the index when the credentials
+                were read.
+        """
+        with self.__login_index_lock:
+            if generation != self.__login_index_generation:
+                return
+            self.__login_index[username] = credentials
+            self.__login_index.move_to_end(username)
+            if len(self.__login_index) > LOGIN_INDEX_SIZE:
+                self.__login_index.popitem(last=False)
+
+    def __unindex_credentials(self, username: str):
+        """
+        Drops the login credentials of a username from the index and bumps its
+        generation, so logins in progress don't index the credentials they read.
+
+        Args:
+            username (str): The username of the user.
+        """
+        with self.__login_index_lock:
+            self.__login_index.pop(username, None)
+            self.__login_index_generation += 1
+
+    def __verify_password(self, hash: str, password: str) -> ErrorCode:
+        """
+        Verifies a password against a stored hash.
+
+        Args:
+            hash (str): The Argon2 hash to check against.
+            password (str): The password to verify.
+
+        Returns:
+            ErrorCode: OK if the password matches, INVALID_LOGIN otherwise.
+        """
         # We need to use a try/except because argon2 raises
         # an exception when a verification fails
         try:
-            hash = user_data.password
-            PasswordHasher().verify(hash, password)
+            self.__hasher.verify(hash, password)
 
         except VerifyMismatchError:
-            return INVALID_LOGIN, ""
+            return INVALID_LOGIN
 
-        else:
-            # Check if user is not already connected
-            uuid = user_data.uuid
-            if uuid in self.__connected_users:
-                return SESSION_CONFLICT, ""
+        return OK
 
-            self.__connected_users.add(uuid)
-            return OK, uuid
+    def login(
+        self, username: str = "", password: str = "", owner: Hashable = None
+    ) -> tuple[ErrorCode, str]:
+        self.logger.debug("Logging in user with username = %s", username)
+
+        # Check empty fields
+        if not username or not password:
+            return _R_BAD_ARGUMENTS
+
+        # Look up the credentials, reading them from the database on a miss
+        credentials, generation = self.__indexed_credentials(username)
+        if credentials is None:
+            # User is not registered
+            user_data = self.__database.read_by_username(username)
+            if user_data is None:
+                self.__verify_password(self.__dummy_hash, password)
+                return _R_INVALID_LOGIN
+
+            credentials = user_data.uuid, user_data.password
+            self.__index_credentials(username, credentials, generation)
+
+        # Validate password
+        uuid, hash = credentials
+        login_error_code = self.__verify_password(hash, password)
+        if login_error_code != OK:
+            return login_error_code, ""
+
+        # Upgrade hashes made with other parameters, e.g. before a recalibration,
+        # so every login costs the same calibrated time. The new hash is only
+        # stored if the password didn't change since it was verified
+        if self.__hasher.check_needs_rehash(hash):
+            self.logger.info("Rehashing password of user with uuid = %s", uuid)
+            new_hash = self.__hasher.hash(password)
+            if self.__database.replace_hash(uuid, hash, new_hash):
+                self.__index_credentials(username, (uuid, new_hash), generation)
+
+        # Check if user is not already connected
+        now = monotonic()
+        self.__sweep_sessions(now)
+
+        connected_users, lock = self.__session_shard(uuid)
+        with lock:
+            session = connected_users.get(uuid)
+            if session is not None and session[0] > now:
+                return _R_SESSION_CONFLICT
+
+            connected_users[uuid] = now + self.__session_ttl, owner
+        return OK, uuid
 
     def change_password(
         self, uuid: str = "", old_password: str = "", new_password: str = ""
     ) -> tuple[ErrorCode, str]:
-        self.logger.debug(
-            f"Changing password for user with uuid = {uuid} and passwords = {old_password} {new_password}"
-        )
+        self.logger.debug("Changing password for user with uuid = %s", uuid)
 
         # Check empty fields
-        if uuid == "" or old_password == "" or new_password == "":
-            return BAD_ARGUMENTS, ""
+        if not uuid or not old_password or not new_password:
+            return _R_BAD_ARGUMENTS
 
         # User is not registered
-        user_data = self.__database.read(uuid=uuid)
+        user_data = self.__database.read_by_uuid(uuid)
         if user_data is None:
-            return UUID_NOT_FOUND, ""
+            return _R_UUID_NOT_FOUND
 
-        # Validate passwords
-        login_error_code, _ = self.login(
-            username=user_data.username, password=old_password
-        )
-        if login_error_code != 0:
+        # Validate old password, without touching the user session
+        login_error_code = self.__verify_password(user_data.password, old_password)
+        if login_error_code != OK:
             return login_error_code, ""
 
-        self.__database.update(uuid=uuid, password=new_password)
-        return OK, ""
+        new_hash = self.__hasher.hash(new_password)
+        self.__database.update(uuid=uuid, password=new_hash)
+        self.__unindex_credentials(user_data.username)
+        return _R_OK
 
     def balance(self, uuid: str = "") -> tuple[ErrorCode, str]:
-        self.logger.debug(f"Checking balance for user with uuid = {uuid}")
+        self.logger.debug("Checking balance for user with uuid = %s", uuid)
 
         # Validate input
-        if uuid == "":
-            return BAD_ARGUMENTS, ""
+        if not uuid:
+            return _R_BAD_ARGUMENTS
 
         # User doesn't exists
-        user_data = self.__database.read(uuid=uuid)
+        user_data = self.__database.read_by_uuid(uuid)
         if user_data is None:
-            return UUID_NOT_FOUND, ""
+            return _R_UUID_NOT_FOUND
 
-        return OK, str(user_data.balance)
+        return OK, format_cents(user_data.balance)
 
     def deposit(self, uuid: str = "", amount: str = "") -> tuple[ErrorCode, str]:
         self.logger.debug(
-            f"Adding funds for user with uuid = {uuid} with amount = {amount}"
+            "Adding funds for user with uuid = %s with amount = %s", uuid, amount
         )
 
         # Validate input
-        if uuid == "" or amount == "":
-            return BAD_ARGUMENTS, ""
+        if not uuid or not amount:
+            return _R_BAD_ARGUMENTS
 
-        # Cast string input to float
-        deposit_amount = float(amount)
-        self.__database.update(uuid=uuid, delta_balance=deposit_amount)
-        return OK, ""
+        # Parse string input to cents
+        deposit_amount = to_cents(amount)
+        if deposit_amount is None:
+            return _R_BAD_ARGUMENTS
+
+        # User doesn't exist, or the new balance wouldn't fit in the database
+        try:
+            self.__database.update(uuid=uuid, delta_balance=deposit_amount)
+        except NameError:
+            return _R_UUID_NOT_FOUND
+        except OverflowError:
+            return _R_BAD_ARGUMENTS
+        return _R_OK
 
     def withdraw(self, uuid: str = "", amount: str = "") -> tuple[ErrorCode, str]:
         """
@@ -163,31 +598,29 @@ class Bank:
 
         Args:
             uuid (str): The UUID of the user.
-            amount (float): The amount to withdraw.
+            amount (str): The amount to withdraw.
 
         Returns:
             tuple[ErrorCode, str]: A tuple containing the error code and additional information.
         """
         self.logger.debug(
-            f"Withdrawing funds from user with uuid = {uuid} with amount = {amount}"
+            "Withdrawing funds from user with uuid = %s with amount = %s", uuid, amount
         )
 
         # Validate input
-        if uuid == "" or amount == "":
-            return BAD_ARGUMENTS, ""
-
-        # Check funds
-        error_code, balance = self.balance(uuid)
-        if error_code != OK:
-            return UUID_NOT_FOUND, ""
+        if not uuid or not amount:
+            return _R_BAD_ARGUMENTS
 
-        balance = float(balance)
-        withdraw_amount = float(amount)
-        if balance - withdraw_amount < 0.0:
-            return INSUFFICIENT_FUNDS, ""
+        # Parse string input to cents
+        withdraw_amount = to_cents(amount)
+        if withdraw_amount is None:
+            return _R_BAD_ARGUMENTS
 
-        self.__database.update(uuid=uuid, delta_balance=-withdraw_amount)
-        return OK, ""
+        # Check funds and debit them in a single statement
+        withdraw_error_code = self.__database.withdraw(
+            uuid=uuid, amount=withdraw_amount
+        )
+        return withdraw_error_code, ""
 
     def transfer(
         self, sender_uuid: str = "", receiver_uuid: str = "", amount: str = ""
@@ -198,30 +631,44 @@ class Bank:
         Args:
             sender_uuid (str): The UUID of the sender.
             receiver_uuid (str): The UUID of the receiver.
-            amount (float): The amount to transfer.
+            amount (str): The amount to transfer.
 
         Returns:
             tuple[ErrorCode, str]: A tuple containing the error code and additional information.
         """
         self.logger.debug(
-            f"Transfering funds from user with uuid = {sender_uuid} to user with uuid = {receiver_uuid} with amount = {amount}"
+            "Transfering funds from user with uuid = %s to user with uuid = %s with amount = %s",
+            sender_uuid,
+            receiver_uuid,
+            amount,
         )
 
         # Validate input
-        if sender_uuid == "" or receiver_uuid == "" or amount == "":
-            return BAD_ARGUMENTS, ""
+        if not sender_uuid or not receiver_uuid or not amount:
+            return _R_BAD_ARGUMENTS
 
-        # Verify that receiver account exists
-        if self.__database.read(uuid=receiver_uuid) is None:
-            return UUID_NOT_FOUND, ""
+        # Parse string input to cents
+        transfer_amount = to_cents(amount)
+        if transfer_amount is None:
+            return _R_BAD_ARGUMENTS
 
-        # Check funds
-        withdraw_error_code, _ = self.withdraw(uuid=sender_uuid, amount=amount)
-
-        if withdraw_error_code == OK:
-            return self.deposit(uuid=receiver_uuid, amount=amount)
-
-        return withdraw_error_code, ""
+        # Verify that receiver account exists
+        if self.__database.read_by_uuid(receiver_uuid) is None:
+            return _R_UUID_NOT_FOUND
+
+        # Nothing to move, as long as the sender account exists too
+        if transfer_amount == 0 or sender_uuid == receiver_uuid:
+            if self.__database.read_by_uuid(sender_uuid) is None:
+                return _R_UUID_NOT_FOUND
+            return _R_OK
+
+        # Check funds and move them in a single transaction
+        transfer_error_code = self.__database.transfer(
+            sender_uuid=sender_uuid,
+            receiver_uuid=receiver_uuid,
+            amount=transfer_amount,
+        )
+        return transfer_error_code, ""
 
 
 #     def pay(
@@ -254,11 +701,11 @@ class Bank:
 #             return 253, ""
 #
 #         # Verify that receiver account exists
-#         if self.__database.read(uuid=receiver_uuid) is None:
+#         if self.__database.read_by_uuid(receiver_uuid) is None:
 #             return 252, ""
 #
 #         # Verify that sender account exists and its password is correct
-#         user = self.__database.read(uuid=sender_uuid)
+#         user = self.__database.read_by_uuid(sender_uuid)
 #         if user is None:
 #             return 253, ""
 #         username = user.get_data()[1]
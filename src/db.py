@@ -1,16 +1,81 @@
 # Standard library modules
+import os
 import sqlite3
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-
-# Third party modules
-from argon2 import PasswordHasher
+from threading import Lock
 
 # Local modules
-from src.utils import setup_logger
-
-
-@dataclass
+from src.utils import ErrorCode, setup_logger
+
+# Version of the 'bank' table layout, stored in the database user_version
+SCHEMA_VERSION = 2
+
+# Rows are stored inline with their uuid key (WITHOUT ROWID), so a lookup by
+# uuid is a single B-tree probe, usernames get their own UNIQUE index
+_SQL_CREATE_TABLE = """
+    CREATE TABLE bank (
+        uuid TEXT PRIMARY KEY,
+        username TEXT UNIQUE,
+        hash TEXT,
+        balance INTEGER
+    ) WITHOUT ROWID;
+"""
+
+# Per connection settings: commit without a fsync per transaction (safe in WAL
+# mode), keep temporary tables, 64 MiB of page cache and 256 MiB of mapped
+# database in memory, and wait up to 5 seconds for locks held by other writers
+CONNECTION_PRAGMAS = """
+    PRAGMA synchronous = NORMAL;
+    PRAGMA temp_store = MEMORY;
+    PRAGMA cache_size = -65536;
+    PRAGMA mmap_size = 268435456;
+    PRAGMA busy_timeout = 5000;
+"""
+
+# Biggest balance that can be stored, SQLite integers are signed 64 bits
+MAX_BALANCE = 2**63 - 1
+
+# Statements used by UserDatabase, kept as constants so they are compiled once
+# and then served from the statement cache of the connection
+_SQL_INSERT = """
+    INSERT INTO bank (uuid, username, hash, balance)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(username) DO NOTHING;
+"""
+_SQL_SELECT_BY_UUID = "SELECT uuid, username, hash, balance FROM bank WHERE uuid = ?"
+_SQL_SELECT_BY_USERNAME = (
+    "SELECT uuid, username, hash, balance FROM bank WHERE username = ?"
+)
+_SQL_UPDATE_HASH = "UPDATE bank SET hash = ? WHERE uuid = ?"
+_SQL_REPLACE_HASH = "UPDATE bank SET hash = ? WHERE uuid = ? AND hash = ?"
+
+# Balance updates match no row when the new balance wouldn't fit, otherwise
+# SQLite would silently store it as a REAL. The last parameter is the amount
+# added, 0 for withdrawals
+_SQL_UPDATE_BALANCE = f"""
+    UPDATE bank SET balance = balance + ?
+    WHERE uuid = ? AND balance <= {MAX_BALANCE} - ?
+"""
+_SQL_UPDATE_HASH_AND_BALANCE = f"""
+    UPDATE bank SET hash = ?, balance = balance + ?
+    WHERE uuid = ? AND balance <= {MAX_BALANCE} - ?
+"""
+_SQL_WITHDRAW = "UPDATE bank SET balance = balance - ? WHERE uuid = ? AND balance >= ?"
+_SQL_EXISTS = "SELECT 1 FROM bank WHERE uuid = ?"
+_SQL_DELETE = "DELETE FROM bank WHERE uuid = ?"
+
+# Number of compiled statements kept by each connection
+CACHED_STATEMENTS = 256
+
+# Number of users read by UUID kept in memory
+READ_CACHE_SIZE = 1024
+
+
+@dataclass(slots=True)
 class User:
     """
     Represents a user in the bank with a unique identifier (UUID),
@@ -20,20 +85,20 @@ class User:
         uuid (str): A unique identifier (UUID) for the user.
         username (str): The username associated with the user.
         password (str): The hashed password of the user.
-        balance (float): The balance associated with the user.
+        balance (int): The balance associated with the user, in cents.
     """
 
     uuid: str
     username: str
     password: str
-    balance: float = 0.0
+    balance: int = 0
 
-    def get_data(self) -> tuple[str, str, str, float]:
+    def get_data(self) -> tuple[str, str, str, int]:
         """
         Retrieves all the User data as a tuple containing each attribute.
 
         Returns:
-            tuple[str, str, str, float]: A tuple containing User data.
+            tuple[str, str, str, int]: A tuple containing User data.
         """
         return self.uuid, self.username, self.password, self.balance
 
@@ -46,100 +111,273 @@ class UserDatabase:
         dbpath (str): The path to the SQLite database file.
 
     Methods:
-        create(user: User): Inserts a new user into the database.
-        read(uuid: str): Reads an existing user from the database.
-        update(uuid: str, password: str, delta_balance: float): Updates a password and/or adds to the balance of an existing user.
+        create(user: User): Inserts a new user into the database, if its username is free.
+        create_many(users: list[User]): Inserts several new users into the database at once.
+        read(uuid: str, username: str): Reads an existing user from the database.
+        read_by_uuid(uuid: str): Reads an existing user from the database by UUID.
+        read_by_username(username: str): Reads an existing user from the database by username.
+        update(uuid: str, password: str, delta_balance: int): Updates a password and/or adds to the balance of an existing user.
+        replace_hash(uuid: str, old_hash: str, new_hash: str): Replaces the password hash of an existing user if it is unchanged.
+        withdraw(uuid: str, amount: int): Takes funds from an existing user if they can afford it.
+        transfer(sender_uuid: str, receiver_uuid: str, amount: int): Moves funds between two existing users.
         delete(uuid: str): Removes an existing user from the database.
+        close(): Closes the connection to the database.
     """
 
-    def __init__(self, dbpath: Path, verbose: bool = False):
+    def __init__(self, dbpath: str | Path, verbose: bool = False):
         """
         Initializes the database with a standard bank table containing the
         User data.
 
         Args:
-            dbpath (str): The path to the DB.
+            dbpath (str | Path): The path to the DB.
         """
         self.__logger = setup_logger(name="db", verbose=verbose)
-        self.__logger.debug(f"Instantiating new UserDatabase with dbpath = {dbpath}")
+        self.__logger.debug("Instantiating new UserDatabase with dbpath = %s", dbpath)
+
+        self.__dbpath = Path(dbpath)
+        self.__lock = Lock()
+        self.__pid = -1
+        self.__conn: sqlite3.Connection | None = None
 
-        self.__dbpath = dbpath
+        # Rows of the most recently read users by UUID, every write drops the
+        # rows it touches so they are read again from the database
+        self.__cache: OrderedDict[str, tuple[str, str, str, int]] = OrderedDict()
 
         # Create directories if they don't exist
         if not self.__dbpath.is_file():
             self.__logger.debug("Creating database file")
             self.__dbpath.parent.mkdir(parents=True, exist_ok=True)
 
-        # Create table if it doesn't exists
-        with sqlite3.connect(self.__dbpath) as connection:
-            connection.execute(
-                """
-                    CREATE TABLE IF NOT EXISTS bank (
-                        uuid TEXT PRIMARY KEY,
-                        username TEXT UNIQUE,
-                        hash TEXT,
-                        balance REAL
-                    );
-                """
-            )
+        with self.__connection() as connection:
+            # Write ahead log lets readers work while a write is in progress, the
+            # mode is persistent, so it only has to be set once
+            connection.execute("PRAGMA journal_mode = WAL")
+
+            table = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'bank'"
+            ).fetchone()
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+            # Create table if it doesn't exists
+            if table is None:
+                connection.executescript(
+                    f"""
+                        {_SQL_CREATE_TABLE}
+                        PRAGMA user_version = {SCHEMA_VERSION};
+                    """
+                )
+
+            # Rebuild tables created by older versions
+            elif version < SCHEMA_VERSION:
+                self.__logger.info(
+                    "Migrating database from version %s to %s", version, SCHEMA_VERSION
+                )
+
+                # Version 0 stored balances as REAL amounts instead of cents
+                balance = (
+                    "CAST(ROUND(balance * 100) AS INTEGER)"
+                    if version < 1
+                    else "balance"
+                )
+                connection.executescript(
+                    f"""
+                        BEGIN;
+                        ALTER TABLE bank RENAME TO bank_old;
+                        {_SQL_CREATE_TABLE}
+                        INSERT INTO bank (uuid, username, hash, balance)
+                        SELECT uuid, username, hash, {balance}
+                        FROM bank_old;
+                        DROP TABLE bank_old;
+                        PRAGMA user_version = {SCHEMA_VERSION};
+                        COMMIT;
+                    """
+                )
         self.__logger.info("Database succesfully loaded.")
 
-    def create(self, user: User):
+    @contextmanager
+    def __connection(self, transaction: bool = False) -> Iterator[sqlite3.Connection]:
+        """
+        Hands out the long-lived connection to the database while holding the
+        lock, reopening it when the process was forked since sqlite3 handles
+        can't be shared between processes.
+
+        Args:
+            transaction (bool, optional): Whether to run everything inside a single
+            transaction, committed on success and rolled back on errors. Defaults to False.
+
+        Yields:
+            sqlite3.Connection: The connection, in autocommit mode.
+        """
+        with self.__lock:
+            if self.__conn is None or self.__pid != os.getpid():
+                self.__logger.debug("Opening connection in process %s", os.getpid())
+                self.__conn = sqlite3.connect(
+                    self.__dbpath,
+                    check_same_thread=False,
+                    isolation_level=None,
+                    cached_statements=CACHED_STATEMENTS,
+                )
+                self.__conn.executescript(CONNECTION_PRAGMAS)
+                self.__pid = os.getpid()
+
+            connection = self.__conn
+            if not transaction:
+                yield connection
+                return
+
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                if connection.in_transaction:
+                    connection.rollback()
+                raise
+            if connection.in_transaction:
+                connection.commit()
+
+    def close(self):
+        """
+        Lets SQLite refresh its query planner statistics and closes the
+        connection to the database.
+        """
+        with self.__lock:
+            if self.__conn is not None and self.__pid == os.getpid():
+                self.__conn.execute("PRAGMA optimize")
+                self.__conn.close()
+            self.__conn = None
+
+    def __del__(self):
+        if getattr(self, "_UserDatabase__conn", None) is not None:
+            self.close()
+
+    def create(self, user: User) -> bool:
         """
         Inserts a new user into the 'bank' table of the database.
 
         Args:
             user (User): The User instance to be inserted into the database.
+
+        Returns:
+            bool: True if the user was inserted, False if its username is taken.
         """
-        self.__logger.debug(f"Creating user with data = {user.get_data()}")
+        self.__logger.debug(
+            "Creating user with uuid = %s and username = %s", user.uuid, user.username
+        )
 
-        with sqlite3.connect(self.__dbpath) as connection:
-            connection.execute(
-                """
-                    INSERT INTO bank (uuid, username, hash, balance)
-                    VALUES (?, ?, ?, ?)
-                    ON CONFLICT(username) DO NOTHING;
-                """,
-                user.get_data(),
-            )
+        with self.__connection() as connection:
+            cursor = connection.execute(_SQL_INSERT, user.get_data())
+            self.__cache.pop(user.uuid, None)
+            return cursor.rowcount == 1
+
+    def create_many(self, users: list[User]) -> list[bool]:
+        """
+        Inserts several users into the 'bank' table of the database in a
+        single transaction.
+
+        Args:
+            users (list[User]): The User instances to be inserted into the database.
+
+        Returns:
+            list[bool]: Whether each user was inserted, in order. Users whose
+            username is taken, e.g. by a concurrent registration, are skipped.
+        """
+        self.__logger.debug("Creating %s users", len(users))
+
+        # Each insert reports its own row count, unlike executemany
+        inserted = []
+        with self.__connection(transaction=True) as connection:
+            for user in users:
+                cursor = connection.execute(_SQL_INSERT, user.get_data())
+                self.__cache.pop(user.uuid, None)
+                inserted.append(cursor.rowcount == 1)
+        return inserted
 
     def read(self, uuid: str = "", username: str = "") -> User | None:
         """
-        Retrieves a user from the 'bank' table by UUID.
+        Retrieves a user from the 'bank' table by UUID, or by username if no
+        UUID is given.
 
         Args:
             uuid (str): The UUID of the user to be retrieved.
+            username (str): The username of the user to be retrieved.
 
         Returns:
             User | None: A User instance if found, or None if the user is not found.
         """
-        search_keyword = "uuid" if uuid != "" else "username"
-        search_value = uuid if search_keyword == "uuid" else username
-        self.__logger.debug(f"Reading user with {search_keyword} = {search_value}")
+        if uuid != "":
+            return self.read_by_uuid(uuid)
+        return self.read_by_username(username)
 
-        with sqlite3.connect(self.__dbpath) as connection:
-            cursor = connection.cursor()
-            query = f"SELECT * FROM bank WHERE {search_keyword} = ?"
-            result = cursor.execute(
-                query,
-                (search_value,),
-            )
-            user = result.fetchone()
-            self.__logger.debug(f"Got {user if user is not None else 'nothing'}")
+    def read_by_uuid(self, uuid: str) -> User | None:
+        """
+        Retrieves a user from the 'bank' table by UUID, serving recently read
+        users from memory.
+
+        Args:
+            uuid (str): The UUID of the user to be retrieved.
+
+        Returns:
+            User | None: A User instance if found, or None if the user is not found.
+        """
+        self.__logger.debug("Reading user with uuid = %s", uuid)
+
+        with self.__connection() as connection:
+            user = self.__cache.get(uuid)
+            if user is not None:
+                self.__cache.move_to_end(uuid)
+            else:
+                user = connection.execute(_SQL_SELECT_BY_UUID, (uuid,)).fetchone()
+                self.__cache_row(user)
+            self.__logger.debug("Got %s", user[0] if user is not None else "nothing")
+
+            return User(*user) if user is not None else user
+
+    def read_by_username(self, username: str) -> User | None:
+        """
+        Retrieves a user from the 'bank' table by username.
+
+        Args:
+            username (str): The username of the user to be retrieved.
+
+        Returns:
+            User | None: A User instance if found, or None if the user is not found.
+        """
+        self.__logger.debug("Reading user with username = %s", username)
+
+        with self.__connection() as connection:
+            user = connection.execute(_SQL_SELECT_BY_USERNAME, (username,)).fetchone()
+            self.__cache_row(user)
+            self.__logger.debug("Got %s", user[0] if user is not None else "nothing")
 
             return User(*user) if user is not None else user
 
-    def update(self, uuid: str, password: str = "", delta_balance: float = 0.0):
+    def __cache_row(self, row: tuple[str, str, str, int] | None):
+        """
+        Stores a row read from the database in the cache of users by UUID,
+        dropping the least recently used one when it is full.
+
+        Args:
+            row (tuple[str, str, str, int] | None): The row to store, if any.
+        """
+        if row is None:
+            return
+        self.__cache[row[0]] = row
+        if len(self.__cache) > READ_CACHE_SIZE:
+            self.__cache.popitem(last=False)
+
+    def update(self, uuid: str, password: str = "", delta_balance: int = 0):
         """
         Updates user information in the 'bank' table.
 
         Args:
             uuid (str): The UUID of the user to be updated.
-            password (str, optional): The new password for the user. Defaults to an empty string.
-            delta_balance (float, optional): The change in balance for the user. Defaults to 0.0.
+            password (str, optional): The new hashed password for the user. Defaults to an empty string.
+            delta_balance (int, optional): The change in balance for the user, in cents. Defaults to 0.
 
         Raises:
             NameError: If the user with the specified UUID is not found.
+            OverflowError: If the new balance would exceed MAX_BALANCE.
 
         Note:
             At least one parameter between 'password' and 'delta_balance' has to be provided,
@@ -152,55 +390,181 @@ class UserDatabase:
 
             Args:
                 uuid (str): The UUID of the user.
-                password (str): The new password for the user.
+                password (str): The new hashed password for the user.
             """
-            self.__logger.debug(
-                f"Updating password for uuid = {uuid}, using password = {password}"
-            )
+            self.__logger.debug("Updating password for uuid = %s", uuid)
 
-            with sqlite3.connect(self.__dbpath) as connection:
-                connection.execute(
-                    """
-                        UPDATE bank
-                        SET hash = ?
-                        WHERE uuid = ?
-                    """,
-                    (PasswordHasher().hash(password), uuid),
-                )
+            with self.__connection() as connection:
+                connection.execute(_SQL_UPDATE_HASH, (password, uuid))
+                self.__cache.pop(uuid, None)
 
-        def __update_balance(uuid: str, delta_balance: float):
+        def __update_balance(uuid: str, delta_balance: int):
             """
             Updates the balance for a user in the 'bank' table.
 
             Args:
                 uuid (str): The UUID of the user.
-                delta_balance (float): The change in balance for the user.
+                delta_balance (int): The change in balance for the user, in cents.
             """
             self.__logger.debug(
-                f"Updating balance for uuid = {uuid}, using delta_balance = {delta_balance}"
+                "Updating balance for uuid = %s, using delta_balance = %s",
+                uuid,
+                delta_balance,
             )
 
-            with sqlite3.connect(self.__dbpath) as connection:
-                user = self.read(uuid=uuid)
-                if user is None:
-                    raise NameError(f"User with UUID {uuid} not found.")
-                current_balance = user.balance
-                new_balance = current_balance + delta_balance
-                connection.execute(
-                    """
-                        UPDATE bank
-                        SET balance = ?
-                        WHERE uuid = ?
-                    """,
-                    (new_balance, uuid),
+            with self.__connection() as connection:
+                cursor = connection.execute(
+                    _SQL_UPDATE_BALANCE, (delta_balance, uuid, max(delta_balance, 0))
+                )
+                self.__cache.pop(uuid, None)
+                if cursor.rowcount == 0:
+                    self.__raise_update_error(connection, uuid)
+
+        # Both changes go in a single statement
+        if password != "" and delta_balance != 0:
+            self.__logger.debug(
+                "Updating password and balance for uuid = %s, using delta_balance = %s",
+                uuid,
+                delta_balance,
+            )
+
+            with self.__connection() as connection:
+                cursor = connection.execute(
+                    _SQL_UPDATE_HASH_AND_BALANCE,
+                    (password, delta_balance, uuid, max(delta_balance, 0)),
                 )
+                self.__cache.pop(uuid, None)
+                if cursor.rowcount == 0:
+                    self.__raise_update_error(connection, uuid)
+            return
 
         if password != "":
             __update_password(uuid, password)
 
-        if delta_balance != 0.0:
+        if delta_balance != 0:
             __update_balance(uuid, delta_balance)
 
+    def __raise_update_error(self, connection: sqlite3.Connection, uuid: str):
+        """
+        Finds out why a balance update matched no row and raises accordingly.
+
+        Args:
+            connection (sqlite3.Connection): The connection the update ran on.
+            uuid (str): The UUID of the updated user.
+
+        Raises:
+            NameError: If the user with the specified UUID is not found.
+            OverflowError: If the user exists, so its balance would have overflowed.
+        """
+        if connection.execute(_SQL_EXISTS, (uuid,)).fetchone() is None:
+            raise NameError(f"User with UUID {uuid} not found.")
+        raise OverflowError(f"Balance of user with UUID {uuid} would overflow.")
+
+    def replace_hash(self, uuid: str, old_hash: str, new_hash: str) -> bool:
+        """
+        Replaces the password hash of a user only if it is still the given one,
+        so a rehash can't overwrite a password changed in the meantime.
+
+        Args:
+            uuid (str): The UUID of the user.
+            old_hash (str): The hash expected to be stored.
+            new_hash (str): The hash to store instead.
+
+        Returns:
+            bool: True if the hash was replaced, False if it had changed or the
+            user doesn't exist.
+        """
+        self.__logger.debug("Replacing password for uuid = %s", uuid)
+
+        with self.__connection() as connection:
+            cursor = connection.execute(_SQL_REPLACE_HASH, (new_hash, uuid, old_hash))
+            self.__cache.pop(uuid, None)
+            return cursor.rowcount == 1
+
+    def withdraw(self, uuid: str, amount: int) -> ErrorCode:
+        """
+        Takes funds from a user with a single conditional update, so the funds
+        check and the debit can't be split by a concurrent withdrawal.
+
+        Args:
+            uuid (str): The UUID of the user.
+            amount (int): The amount to withdraw, in cents.
+
+        Returns:
+            ErrorCode: OK if the funds were withdrawn, INSUFFICIENT_FUNDS if the
+            user can't afford it or UUID_NOT_FOUND if the user doesn't exist.
+        """
+        self.__logger.debug("Withdrawing %s from uuid = %s", amount, uuid)
+
+        with self.__connection() as connection:
+            cursor = connection.execute(_SQL_WITHDRAW, (amount, uuid, amount))
+            self.__cache.pop(uuid, None)
+
+            # Nothing was withdrawn, find out why
+            if cursor.rowcount == 0:
+                user = connection.execute(_SQL_EXISTS, (uuid,)).fetchone()
+                return (
+                    ErrorCode.UUID_NOT_FOUND
+                    if user is None
+                    else ErrorCode.INSUFFICIENT_FUNDS
+                )
+
+        return ErrorCode.OK
+
+    def transfer(self, sender_uuid: str, receiver_uuid: str, amount: int) -> ErrorCode:
+        """
+        Moves funds from one user to another in a single transaction, so the
+        funds check and both balance updates are atomic.
+
+        Args:
+            sender_uuid (str): The UUID of the sender.
+            receiver_uuid (str): The UUID of the receiver.
+            amount (int): The amount to transfer, in cents.
+
+        Returns:
+            ErrorCode: OK if the transfer was committed, INSUFFICIENT_FUNDS if the
+            sender can't afford it, UUID_NOT_FOUND if any of the users doesn't exist
+            or BAD_ARGUMENTS if the receiver balance would exceed MAX_BALANCE.
+        """
+        self.__logger.debug(
+            "Transfering %s from uuid = %s to uuid = %s",
+            amount,
+            sender_uuid,
+            receiver_uuid,
+        )
+
+        with self.__connection(transaction=True) as connection:
+            cursor = connection.execute(_SQL_WITHDRAW, (amount, sender_uuid, amount))
+
+            # Nothing was withdrawn, find out why
+            if cursor.rowcount == 0:
+                sender = connection.execute(_SQL_EXISTS, (sender_uuid,)).fetchone()
+                connection.rollback()
+                return (
+                    ErrorCode.UUID_NOT_FOUND
+                    if sender is None
+                    else ErrorCode.INSUFFICIENT_FUNDS
+                )
+
+            cursor = connection.execute(
+                _SQL_UPDATE_BALANCE, (amount, receiver_uuid, amount)
+            )
+
+            # Receiver doesn't exist or can't hold the amount, undo the withdrawal
+            if cursor.rowcount == 0:
+                receiver = connection.execute(_SQL_EXISTS, (receiver_uuid,)).fetchone()
+                connection.rollback()
+                return (
+                    ErrorCode.UUID_NOT_FOUND
+                    if receiver is None
+                    else ErrorCode.BAD_ARGUMENTS
+                )
+
+            self.__cache.pop(sender_uuid, None)
+            self.__cache.pop(receiver_uuid, None)
+
+        return ErrorCode.OK
+
     def delete(self, uuid: str):
         """
         Deletes a user from the 'bank' table based on the provided UUID.
@@ -208,13 +572,8 @@ class UserDatabase:
         Args:
             uuid (str): The UUID of the user to be deleted.
         """
-        self.__logger.debug(f"Deleting user with uuid = {uuid}")
+        self.__logger.debug("Deleting user with uuid = %s", uuid)
 
-        with sqlite3.connect(self.__dbpath) as connection:
-            connection.execute(
-                """
-                    DELETE FROM bank 
-                    WHERE uuid = ?;
-                """,
-                (uuid,),
-            )
+        with self.__connection() as connection:
+            connection.execute(_SQL_DELETE, (uuid,))
+            self.__cache.pop(uuid, None)
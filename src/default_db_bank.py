@@ -1,24 +1,34 @@
 #!/usr/bin/python
 
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
-from argon2 import PasswordHasher
 from src import db
+from src.bank import hashing_workers, load_hasher
+
+# Same default location used by the server
+DBPATH = Path("./db/bank.db")
 
 # Static user data
 usernames = ["donCESAR12345", "evil_leal", "johan", "yuruk", "sanket"]
 passwords = ["soyunserdeluz", "tele", "cesarteodio", "genshin123", "funcional"]
 
-# UUID for each user, username, hashed password and initial balance
-ph = PasswordHasher()
+# A single hasher with the same tuned Argon2 parameters the Bank uses
+ph = load_hasher(DBPATH.parent / "argon2.json")
+
+# Hash the passwords in parallel, libargon2 releases the GIL
+with ThreadPoolExecutor(max_workers=hashing_workers(ph, len(passwords))) as ex:
+    hashes = list(ex.map(ph.hash, passwords))
+
+# UUID for each user, username, hashed password and initial balance in cents
 clients = [
-    db.User(str(uuid.uuid4()), username, ph.hash(password), 250_000)
-    for username, password in zip(usernames, passwords)
+    db.User(str(uuid.uuid4()), username, hash, 25_000_000)
+    for username, hash in zip(usernames, hashes)
 ]
 
 # Create new database
-database = db.UserDatabase()
+database = db.UserDatabase(DBPATH)
 
-# Insert default clients
-for client in clients:
-    database.create(client)
+# Insert default clients in a single transaction
+database.create_many(clients)
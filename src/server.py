@@ -2,126 +2,85 @@
 # Standard library modules
 import ssl
 
+from functools import partial
+from itertools import count
 from logging import Logger
 from pathlib import Path
 from socketserver import (
     BaseRequestHandler,
-    ForkingTCPServer,
-    ForkingUDPServer,
+    StreamRequestHandler,
+    ThreadingTCPServer,
+    ThreadingUDPServer,
 )
-from threading import Thread
+from threading import Lock
+from typing import Callable
 
 # Local modules
 from src.bank import Bank
 from src.utils import ErrorCode, setup_logger, setup_parser
 
+# Longest command line accepted from a client, in bytes
+MAX_LINE_LENGTH = 4096
 
-class Command:
-    """
-    Represents a command for the banking application with associated functions.
-
-    Attributes:
-        __command (str): The command string.
-        __arguments (list): The list of arguments for the command.
-        __fn (callable): The function associated with the command.
-        __error_code (int): The error code resulting from the command execution.
-
-    Methods:
-        debug(): Logs a debug message when the command is executed.
-        no_fn(_: None) -> tuple[int, str]: Default function for commands without an associated function.
-        bad_args(_: None) -> tuple[int, str]: Function for commands with incorrect arguments.
-        __check_args(args_number: int = 0, fn: callable = no_fn): Checks and sets the associated function based on the command.
-        fn() -> tuple[int, str]: Executes the associated function and returns the result.
-
-    Notes:
-        This class represents a command in the banking application and is associated with specific functions.
-        The associated function is determined based on the command string and the number of arguments.
-    """
-
-    def __init__(self, command: str, arguments: list, bank: Bank, logger: Logger):
-        self.logger = logger
-        self.command = command
-        self.arguments = arguments
-        self.__fn = self.no_fn
-
-        match self.command:
-            case "HI":
-                self.__check_args(args_number=0, fn=self.hi)
-
-            case "LOGIN":
-                self.__check_args(args_number=2, fn=bank.login)
-
-            case "REGISTER":
-                self.__check_args(args_number=2, fn=bank.register)
-
-            case "CHPASSWD":
-                self.__check_args(args_number=3, fn=bank.change_password)
+# Most arguments taken by a command, a line is never split further than one
+# token past it, which is enough to reject it for having too many arguments
+MAX_ARGUMENTS = 3
 
-            case "BALANCE":
-                self.__check_args(args_number=1, fn=bank.balance)
+# Most clients logged in at once, logins past it are refused so the sessions
+# table can't grow without bound
+MAX_SESSIONS = 1024
 
-            case "DEPOSIT":
-                self.__check_args(args_number=2, fn=bank.deposit)
+# Replies without data, encoded once instead of per response
+_ERR_BYTES = {code: f"ERR {code.value}\r\n".encode("utf-8") for code in ErrorCode}
+_OK_EMPTY = b"OK \r\n"
 
-            case "WITHDRAW":
-                self.__check_args(args_number=2, fn=bank.withdraw)
+# Logged message of each error, formatted once
+_ERROR_LOG = {code: f"Error {code.value}: {code}" for code in ErrorCode}
 
-            case "TRANSFER":
-                self.__check_args(args_number=3, fn=bank.transfer)
 
-            case "LOGOUT":
-                self.__check_args(args_number=1, fn=bank.logout)
-
-            #            case "PAY":
-            #                self.__check_args(args_number=4, fn=bank.pay)
-
-            case _:
-                self.arguments = []
-
-    def no_fn(self, _=None) -> tuple[ErrorCode, str]:
-        """
-        Default function for non-valid commands.
-        """
-        return ErrorCode.UNKNOWN_COMMAND, ""
-
-    def bad_args(self, _=None) -> tuple[ErrorCode, str]:
-        """
-        Default function for wrong number of arguments.
-        """
-        return ErrorCode.BAD_ARGUMENTS, ""
+def hi() -> tuple[ErrorCode, str]:
+    # TODO: Check if hostname identification can be done without this using the certificate
+    """
+    Function that handles first connection.
+    """
+    return ErrorCode.OK, "bank"
 
-    def __check_args(self, args_number: int = 0, fn=no_fn):
-        """
-        Checks if the number of arguments supplied is correct.
-        """
-        if len(self.arguments) != args_number:
-            self.arguments = []
-            self.__fn = self.bad_args
-        else:
-            self.__fn = fn
 
-    def hi(self, _=None) -> tuple[ErrorCode, str]:
-        # TODO: Check if hostname identification can be done without this using the certificate
-        """
-        Function that handles first connection.
-        """
-        return ErrorCode.OK, "bank"
+def build_commands(bank: Bank) -> dict[str, tuple[int, Callable]]:
+    """
+    Builds the table used to dispatch the commands of the banking application.
 
-    def fn(self) -> tuple[ErrorCode, str]:
-        """
-        Executes the binded function of the command and returns the error code.
-        """
-        if self.fn != self.no_fn:
-            self.logger.debug(
-                f"Executing {self.command}:{self.arguments}",
-            )
-        self.error_code, data = self.__fn(*self.arguments)
-        if self.error_code == ErrorCode.OK:
-            return ErrorCode.OK, data
-        return self.error_code, ""
+    Args:
+        bank (Bank): The bank that executes the commands.
 
+    Returns:
+        dict[str, tuple[int, Callable]]: The number of arguments and the function
+        of each command.
+    """
+    return {
+        "HI": (0, hi),
+        "LOGIN": (2, bank.login),
+        "REGISTER": (2, bank.register),
+        "CHPASSWD": (3, bank.change_password),
+        "BALANCE": (1, bank.balance),
+        "DEPOSIT": (2, bank.deposit),
+        "WITHDRAW": (2, bank.withdraw),
+        "TRANSFER": (3, bank.transfer),
+        "LOGOUT": (1, bank.logout),
+        # "PAY": (4, bank.pay),
+    }
+
+
+class BankTCPServer(ThreadingTCPServer):
+    # Clients are served by threads sharing this process Bank and database
+    # connection, instead of a forked process per client
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # Pending connections the kernel queues while the accept loop is busy, the
+    # socketserver default of 5 drops clients on bursts
+    request_queue_size = 128
 
-class BankTCPServer(ForkingTCPServer):
     def __init__(
         self,
         server_address: tuple[str, int],
@@ -136,22 +95,38 @@ class BankTCPServer(ForkingTCPServer):
         self.keyfile = keyfile
         self.logger = logger
         self.sessions = {}
+        self.sessions_lock = Lock()
+        # Keys of the sessions, unique per connection unlike socket descriptors,
+        # which the kernel reuses as soon as a connection is closed
+        self.session_keys = count()
+        self.commands = build_commands(bank)
 
         # Create SSL context
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         self.logger.debug(
-            f"Loading credentials with certfile = {self.certfile} and keyfile = {self.keyfile}"
+            "Loading credentials with certfile = %s and keyfile = %s",
+            self.certfile,
+            self.keyfile,
         )
         context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
+
+        # The context is shared by every connection, so returning clients can
+        # resume their TLS session with a ticket instead of a full handshake
+        context.options &= ~ssl.OP_NO_TICKET
+        self.ssl_context = context
         self.logger.debug("SSL context created succesfully")
 
         super().__init__(server_address, handler)
-        self.socket = context.wrap_socket(self.socket, server_side=True)
-        self.allow_reuse_port = True
         self.logger.debug("Bank TCP Server instantiated")
 
+    def handle_error(self, request, client_address):
+        self.logger.exception("Error handling connection from %s", client_address)
+
+
+class BankUDPServer(ThreadingUDPServer):
+    daemon_threads = True
+    allow_reuse_address = True
 
-class BankUDPServer(ForkingUDPServer):
     def __init__(
         self,
         server_address: tuple[str, int],
@@ -169,7 +144,9 @@ class BankUDPServer(ForkingUDPServer):
         # Create SSL context
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         self.logger.debug(
-            f"Loading credentials with certfile = {self.certfile} and keyfile = {self.keyfile}"
+            "Loading credentials with certfile = %s and keyfile = %s",
+            self.certfile,
+            self.keyfile,
         )
         context.load_cert_chain(certfile=self.certfile, keyfile=self.keyfile)
         self.logger.debug("SSL context created succesfully")
@@ -179,11 +156,23 @@ class BankUDPServer(ForkingUDPServer):
             handler,
         )
         self.socket = context.wrap_socket(self.socket, server_side=True)
-        self.allow_reuse_port = True
         self.logger.debug("Bank TCP Server instantiated")
 
 
-class BankTCPServerHandler(BaseRequestHandler):
+class BankTCPServerHandler(StreamRequestHandler):
+    # Commands are read line by line from a buffered reader, so a command split
+    # across several TCP segments is put back together and a single recv can
+    # serve many commands. The reader fills its preallocated buffer with
+    # recv_into, sized to hold a whole TLS record (16 KiB of payload) so one is
+    # never read in two calls. Replies are buffered too, see read_command
+    rbufsize = 16384
+    wbufsize = 16384
+
+    # Replies are a few bytes long, without TCP_NODELAY Nagle would hold one
+    # back until the previous reply is acknowledged, which pipelining clients
+    # pay with the peer's delayed ACK timeout
+    disable_nagle_algorithm = True
+
     def __init__(
         self,
         request,
@@ -193,142 +182,277 @@ class BankTCPServerHandler(BaseRequestHandler):
         self.logger = server.logger
         self.bank = server.bank
         self.sessions = server.sessions
+        self.sessions_lock = server.sessions_lock
+        self.commands = server.commands
 
         super().__init__(request, client_address, server)
         self.logger.debug("Bank TCP Server Handler instantiated")
 
+    def setup(self):
+        # Wraps the accepted socket, the TLS handshake runs in the thread of
+        # the client so a slow one doesn't hold the accept loop
+        self.request = self.server.ssl_context.wrap_socket(
+            self.request, server_side=True
+        )
+        super().setup()
+
+        # Received bytes that don't make a full command yet
+        self.pending = bytearray()
+
+        # Sessions are keyed by a number drawn once per connection, a single
+        # int to hash
+        with self.sessions_lock:
+            self.session_key = next(self.server.session_keys)
+
+        # Bank sessions are owned by this connection, so only it can extend or
+        # end them
+        self.commands = {
+            **self.commands,
+            "LOGIN": (2, partial(self.bank.login, owner=self.session_key)),
+            "LOGOUT": (1, partial(self.bank.logout, owner=self.session_key)),
+        }
+
+    def read_command(self) -> bytes:
+        """
+        Reads the next command line sent by the client. Replies are only sent
+        before waiting for more data, so all the commands pipelined in a single
+        read are answered with a single send. Lines longer than MAX_LINE_LENGTH
+        are answered with an error and dropped up to their newline, so no part
+        of them is run as a command.
+
+        Returns:
+            bytes: The command line, or an empty bytes if the client disconnected.
+        """
+        # Bytes already searched for the end of the line
+        searched = 0
+
+        # Whether the start of an overlong line was already dropped
+        discarding = False
+
+        while True:
+            end = self.pending.find(b"\n", searched) + 1
+            if end:
+                line = bytes(self.pending[:end])
+                del self.pending[:end]
+                if not discarding and end <= MAX_LINE_LENGTH:
+                    return line
+
+                # The overlong line ends here, the next one is a new command
+                self.handle_error(ErrorCode.BAD_ARGUMENTS)
+                searched = 0
+                discarding = False
+                continue
+
+            # Too long to be a command, drop it while waiting for its newline
+            if len(self.pending) >= MAX_LINE_LENGTH:
+                self.pending.clear()
+                discarding = True
+
+            # Every received command has been answered, send the replies
+            self.wfile.flush()
+            data = self.rfile.read1(self.rbufsize)
+            if not data:
+                if discarding:
+                    self.handle_error(ErrorCode.BAD_ARGUMENTS)
+                line = bytes(self.pending)
+                self.pending.clear()
+                return line
+            searched = len(self.pending)
+            self.pending += data
+
+    def finish(self):
+        # Drops a session left behind by a connection that ended abruptly, so
+        # the sessions table only holds the connected clients
+        with self.sessions_lock:
+            uuid = self.sessions.pop(self.session_key, None)
+        if uuid is not None:
+            self.bank.logout(uuid, self.session_key)
+
+        super().finish()
+        self.request.close()
+
     def check_user(self, connected_uuid: str, cmd_uuid: str) -> bool:
-        self.logger.debug(f"Checking UUIDs {connected_uuid} = {cmd_uuid}?")
+        self.logger.debug("Checking UUIDs %s = %s?", connected_uuid, cmd_uuid)
         return connected_uuid == cmd_uuid
 
     def handle_error(self, error_code: ErrorCode = ErrorCode.UNKNOWN_ERROR):
-        error_msg = f"Error {error_code.value}: {error_code}"
-        self.logger.error(error_msg)
-        self.request.sendall(f"ERR {error_code.value}".encode("utf-8"))
+        self.logger.error(_ERROR_LOG[error_code])
+        self.wfile.write(_ERR_BYTES[error_code])
 
     def send_ok_data(self, ok_data=""):
-        self.logger.debug(f"OK data: {ok_data}")
-        self.request.sendall(f"OK {ok_data}".encode("utf-8"))
+        self.logger.debug("OK data: %s", ok_data)
+        if not ok_data:
+            self.wfile.write(_OK_EMPTY)
+        else:
+            self.wfile.write(b"OK " + ok_data.encode("utf-8") + b"\r\n")
 
-    def handle_logout(self, client_address: str):
+    def run_command(self, command: str, arguments: list) -> tuple[ErrorCode, str]:
+        """
+        Looks up the command in the dispatch table, checks the number of
+        arguments and executes it.
+        """
+        args_number, fn = self.commands.get(command, (0, None))
+        if fn is None:
+            return ErrorCode.UNKNOWN_COMMAND, ""
+        if len(arguments) != args_number:
+            return ErrorCode.BAD_ARGUMENTS, ""
+
+        self.logger.debug("Executing %s:%s", command, arguments)
+        error_code, data = fn(*arguments)
+        if error_code == ErrorCode.OK:
+            return ErrorCode.OK, data
+        return error_code, ""
+
+    def handle_logout(self, session_key: int):
         # Removes sessions entry for current session and logs the event
-        del self.sessions[client_address]
-        self.logger.info(f"User {self.username} has logged out")
+        with self.sessions_lock:
+            del self.sessions[session_key]
+        self.logger.info("User %s has logged out", self.username)
+
+    def handle_login(self, uuid: str) -> bool:
+        # Updates sessions dictionary, shared by every client thread, ending
+        # the Bank session if it is full
+        with self.sessions_lock:
+            if len(self.sessions) < MAX_SESSIONS:
+                self.sessions[self.session_key] = uuid
+                self.logger.debug("Session %s set to %s", self.session_key, uuid)
+                return True
+
+        self.logger.warning("Refused login of %s, too many sessions", uuid)
+        self.bank.logout(uuid, self.session_key)
+        return False
 
     def handle_pre_login(self, data: str) -> bool:
         # Initializes the logged_in flag
         logged_in = False
 
         # Extracts command and data from input
-        command, *arguments = data.split()
-        cmd = Command(
-            bank=self.bank, command=command, arguments=arguments, logger=self.logger
-        )
-        self.logger.info(f"Command {command} issued by {self.client_address}")
+        command, *arguments = data.split(maxsplit=MAX_ARGUMENTS + 1)
+        self.logger.info("Command %s issued by %s", command, self.client_address)
+
+        # A login is refused if the sessions table is full
+        error_code, cmd_return = self.run_command(command, arguments)
+        if (
+            error_code == ErrorCode.OK
+            and command == "LOGIN"
+            and not self.handle_login(cmd_return)
+        ):
+            error_code = ErrorCode.SESSION_CONFLICT
 
         # Handle error
-        error_code, cmd_return = cmd.fn()
         if error_code != ErrorCode.OK:
             self.handle_error(error_code)
 
         else:
             self.send_ok_data(cmd_return)
             if command == "LOGIN":
-                # Updates sessions dictionary
-                self.logger.debug(f"Sessions set before {self.sessions}")
-                self.sessions[self.client_address] = cmd_return
-
                 # Logs login event and changes the flag
                 self.username = arguments[0]
                 self.uuid = cmd_return
-                self.logger.info(f"User {self.username} has logged in")
-                self.logger.debug(f"Sessions set after {self.sessions}")
+                self.logger.info("User %s has logged in", self.username)
                 logged_in = True
 
         return logged_in
 
     def handle_post_login(self, data: str) -> bool:
         # Extracts command and data from input
-        command, *arguments = data.split()
+        command, *arguments = data.split(maxsplit=MAX_ARGUMENTS + 1)
 
         # Sets connected UUID as argument if not given by client
         if arguments == []:
-            self.logger.debug(f"Arguments list empty, using session UUID as argument")
+            self.logger.debug("Arguments list empty, using session UUID as argument")
             arguments = [self.uuid]
 
-        cmd = Command(
-            bank=self.bank, command=command, arguments=arguments, logger=self.logger
-        )
         self.logger.info(
-            f"Command {command} issued by {self.username}:{self.client_address}"
+            "Command %s issued by %s:%s", command, self.username, self.client_address
         )
 
+        # Every command extends the session, an expired one logs the client out
+        if not self.bank.touch(self.uuid, self.session_key):
+            self.handle_error(ErrorCode.UNAUTHORIZED_ACCESS)
+            self.handle_logout(self.session_key)
+            return False
+
         # Check that UUID argument is the same as the session UUID
         if command != "LOGIN":
-            if not self.check_user(arguments[0], self.sessions[self.client_address]):
+            if not self.check_user(arguments[0], self.uuid):
                 error_code = ErrorCode.UNAUTHORIZED_ACCESS
                 self.handle_error(error_code)
                 return True
 
         # Handle error
-        error_code, cmd_return = cmd.fn()
+        error_code, cmd_return = self.run_command(command, arguments)
         if error_code != ErrorCode.OK:
             self.handle_error(error_code)
             return True
         else:
             self.send_ok_data(cmd_return)
             if command == "LOGOUT":
-                self.handle_logout(self.client_address)
+                self.handle_logout(self.session_key)
                 return False
             return True
 
     def handle(self):
-        self.logger.info(f"Accepted connection from {self.client_address}")
+        self.logger.info("Accepted connection from %s", self.client_address)
         logged = False
 
         while True:
             if not logged:
                 self.logger.debug("Not logged in")
                 # Read data from buffer
-                data = self.request.recv(4096)
-                self.logger.debug(f"Data received: {data}")
+                data = self.read_command()
+                self.logger.debug("Data received: %s", data)
 
                 # Check if client disconnected
                 if not data:
-                    self.logger.info(f"Finished connection from {self.client_address}")
+                    self.logger.info("Finished connection from %s", self.client_address)
                     break
 
                 # Checks non-empty message
-                if len(data) == 0:
+                if not data.strip():
                     self.logger.warning(
-                        f"Empty message received from {self.client_address}"
+                        "Empty message received from %s", self.client_address
                     )
                     continue
 
+                # Only the bytes of this command are decoded, once
+                try:
+                    line = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    self.handle_error(ErrorCode.BAD_ARGUMENTS)
+                    continue
+
                 # Handle pre-login
-                logged = self.handle_pre_login(data.decode("utf-8"))
+                logged = self.handle_pre_login(line)
             else:
                 self.logger.debug("Logged in")
                 # Read data from buffer
-                data = self.request.recv(4096)
-                self.logger.debug(f"Data received: {data}")
+                data = self.read_command()
+                self.logger.debug("Data received: %s", data)
 
-                # Check if client disconnected
+                # Check if client disconnected, the Bank session is shared
+                # by every thread so it has to be closed too
                 if not data:
-                    self.handle_logout(self.client_address)
-                    self.logger.info(f"Finished connection from {self.client_address}")
+                    self.bank.logout(self.uuid, self.session_key)
+                    self.handle_logout(self.session_key)
+                    self.logger.info("Finished connection from %s", self.client_address)
                     break
 
                 # Checks non-empty message
-                if len(data) == 0:
+                if not data.strip():
                     self.logger.warning(
-                        f"Empty message received from {self.client_address}"
+                        "Empty message received from %s", self.client_address
                     )
                     continue
 
-                logged = self.handle_post_login(data.decode("utf-8"))
+                # Only the bytes of this command are decoded, once
+                try:
+                    line = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    self.handle_error(ErrorCode.BAD_ARGUMENTS)
+                    continue
 
-        self.finish()
+                logged = self.handle_post_login(line)
 
 
 class BankUDPServerHandler(BaseRequestHandler):
@@ -499,29 +623,28 @@ class Server:
         self.logger.debug("TCP Server created")
 
         # self.udp_thread = Thread(target=self.udp_server.serve_forever)
-        self.tcp_thread = Thread(target=self.tcp_server.serve_forever)
-        self.logger.debug("Threads created")
 
     def start(self):
-        # Start the threads
         ip, port = self.server_address
         # self.udp_thread.start()
         # self.logger.info(f"UDP Server listening on {ip}:{port}")
-        self.tcp_thread.start()
-        self.logger.info(f"TCP Server listening on {ip}:{port}")
+        self.logger.info("TCP Server listening on %s:%s", ip, port)
 
-        # Wait for both threads to finish
-        # self.udp_thread.join()
-        self.tcp_thread.join()
+        # Serve TCP from the calling thread, Ctrl+C interrupts it directly
+        self.tcp_server.serve_forever()
 
     def stop(self):
         # Empty print to not have the ^C in the same line as the warn
         print("")
         self.logger.warning("Stopping server, please wait...")
 
-        # Shutdown both servers
-        # SERVER.udp_server.shutdown()
-        SERVER.tcp_server.shutdown()
+        # Shutdown both servers and release their sockets
+        # self.udp_server.shutdown()
+        self.tcp_server.shutdown()
+        self.tcp_server.server_close()
+
+        # Let SQLite refresh its statistics before closing the database
+        self.bank.get_db().close()
 
 
 if __name__ == "__main__":
@@ -1,11 +1,16 @@
 # Standard library modules
 import argparse
+import atexit
 import logging
 from enum import Enum
+from functools import lru_cache
 from ipaddress import IPv4Address
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from queue import SimpleQueue
 
 
+@lru_cache(maxsize=1)
 def get_project_root() -> Path | None:
     current_path = Path(__file__)
 
@@ -24,6 +29,7 @@ class Formatter(logging.Formatter):
         FORMATS (dict): A mapping of log levels to their respective formats.
             The formats include the log level, timestamp, and log message.
         DATEFMT (str): The date format for the timestamp.
+        formatters (dict): A mapping of log levels to the formatter of each format.
 
     Methods:
         format(record): Formats a log record into a string.
@@ -39,6 +45,15 @@ class Formatter(logging.Formatter):
 
     DATEFMT = "%d-%m-%Y %H:%M:%S"
 
+    def __init__(self):
+        super().__init__()
+
+        # One formatter per level, built once instead of per record
+        self.formatters = {
+            level: logging.Formatter(log_format, datefmt=self.DATEFMT)
+            for level, log_format in self.FORMATS.items()
+        }
+
     def format(self, record) -> str:
         """
         Formats a log record into a string.
@@ -52,28 +67,62 @@ class Formatter(logging.Formatter):
         Notes:
             This method overrides the format method in the logging.Formatter class.
         """
-        log_format = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_format, datefmt=self.DATEFMT)
+        formatter = self.formatters.get(record.levelno, self.formatters[logging.INFO])
         return formatter.format(record)
 
 
+class _QueueHandler(QueueHandler):
+    """
+    Queue handler that puts records in the queue as they are, so the message
+    and traceback are only formatted by the handlers of the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """
+        Prepares a record for queuing.
+
+        Args:
+            record (LogRecord): The log record to be queued.
+
+        Returns:
+            LogRecord: The same record, unformatted.
+
+        Notes:
+            The arguments of a record are formatted later, so they must not be
+            mutated after logging them.
+        """
+        return record
+
+
+# Console handler shared by every logger, fed through a queue by setup_logger
+_LOG_QUEUE = SimpleQueue()
+_LOG_HANDLER = logging.StreamHandler()
+_LOG_HANDLER.setFormatter(Formatter())
+_LOG_LISTENER = QueueListener(_LOG_QUEUE, _LOG_HANDLER)
+_LOG_LISTENER.start()
+
+# Writes the records still queued before exiting
+atexit.register(_LOG_LISTENER.stop)
+
+
 def setup_logger(name: str = __name__, verbose: bool = False):
     level = logging.DEBUG if verbose else logging.WARN
     logger = logging.getLogger(name)
     logger.setLevel(level)
 
-    # Create console handler and set the level to DEBUG
-    ch = logging.StreamHandler()
-    ch.setLevel(level)
-
-    # Create a formatter
-    formatter = Formatter()
+    # Loggers are shared by name, reuse the handler added by a previous call
+    if logger.handlers:
+        for handler in logger.handlers:
+            handler.setLevel(level)
+        return logger
 
-    # Add the formatter to the handler
-    ch.setFormatter(formatter)
+    # Records are put in a queue, the console handler formats and writes them
+    # from the listener thread so the callers never wait on the console
+    qh = _QueueHandler(_LOG_QUEUE)
+    qh.setLevel(level)
 
     # Add the handler to the logger
-    logger.addHandler(ch)
+    logger.addHandler(qh)
 
     return logger
 
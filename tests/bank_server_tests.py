@@ -1,16 +1,32 @@
 # Standard library modules
+import socket
+import sqlite3
+import ssl
 import unittest
 
-from os import remove
+from os import cpu_count, remove
 from pathlib import Path
+from threading import Barrier, Thread
+from time import sleep
+from unittest.mock import patch
 
 # Third party modules
 import argon2
 
 # Local modules
-from src.bank import Bank
-from src.db import User, UserDatabase
-from src.utils import ErrorCode
+from src.bank import (
+    ARGON2_MIN_MEMORY_COST,
+    ARGON2_MIN_TIME_COST,
+    Bank,
+    calibrate_hasher,
+    format_cents,
+    hashing_workers,
+    load_hasher,
+    to_cents,
+)
+from src.db import MAX_BALANCE, SCHEMA_VERSION, User, UserDatabase
+from src.server import MAX_LINE_LENGTH, BankTCPServer, BankTCPServerHandler
+from src.utils import ErrorCode, setup_logger
 
 # Globals
 OK = ErrorCode.OK
@@ -23,6 +39,10 @@ UUID_NOT_FOUND = ErrorCode.UUID_NOT_FOUND
 BAD_ARGUMENTS = ErrorCode.BAD_ARGUMENTS
 UNKNOWN_ERROR = ErrorCode.UNKNOWN_ERROR
 
+# Shared by every test, so its parameters are only set up once. Uses the
+# cheapest parameters Argon2 allows, as the tests don't need a strong hash
+PH = argon2.PasswordHasher(time_cost=1, memory_cost=8, parallelism=1)
+
 
 class TestDB(unittest.TestCase):
     """
@@ -30,13 +50,13 @@ class TestDB(unittest.TestCase):
     """
 
     def setUp(self):
-        self.path = Path("test.db")
+        self.path = Path(":memory:")
         self.user_db = UserDatabase(self.path)
         self.user = User(
             uuid="aaaa-aaaa-aaaa-aaaa",
             username="test_user1",
-            password=argon2.PasswordHasher().hash("password1"),
-            balance=0.0,
+            password=PH.hash("password1"),
+            balance=0,
         )
         self.user_db.create(self.user)
 
@@ -80,17 +100,29 @@ class TestDB(unittest.TestCase):
 
     def test_password_update(self):
         new_password = "new_password"
-        self.user_db.update(uuid=self.user.uuid, password=new_password)
+        self.user_db.update(uuid=self.user.uuid, password=PH.hash(new_password))
 
         updated_user = self.user_db.read(uuid=self.user.uuid)
         if updated_user is not None:
-            self.assertTrue(
-                argon2.PasswordHasher().verify(updated_user.password, new_password)
-            )
+            self.assertTrue(PH.verify(updated_user.password, new_password))
+
+    def test_hash_replacement(self):
+        new_hash = "new_hash"
+
+        # Only replaced while the stored hash is the expected one
+        self.assertFalse(self.user_db.replace_hash(self.user.uuid, "other", new_hash))
+        self.assertTrue(
+            self.user_db.replace_hash(self.user.uuid, self.user.password, new_hash)
+        )
+
+        updated_user = self.user_db.read(uuid=self.user.uuid)
+        self.assertIsNotNone(updated_user)
+        if updated_user is not None:
+            self.assertEqual(updated_user.password, new_hash)
 
     def test_balance_update(self):
         # Update the user's balance, expected should be delta because initial is zero
-        delta_balance = 200.0
+        delta_balance = 20000
         expected_balance = delta_balance
 
         self.user_db.update(uuid=self.user.uuid, delta_balance=delta_balance)
@@ -99,28 +131,204 @@ class TestDB(unittest.TestCase):
         if updated_user is not None:
             self.assertEqual(updated_user.balance, expected_balance)
 
+    def test_cached_user_retrieval_after_update(self):
+        delta_balance = 20000
+
+        # Read once so the user is cached, then update it
+        self.user_db.read(uuid=self.user.uuid)
+        self.user_db.update(uuid=self.user.uuid, delta_balance=delta_balance)
+
+        updated_user = self.user_db.read(uuid=self.user.uuid)
+        self.assertIsNotNone(updated_user)
+        if updated_user is not None:
+            self.assertEqual(updated_user.balance, delta_balance)
+
+    def test_password_and_balance_update(self):
+        new_hash = "new_hash"
+        delta_balance = 20000
+
+        self.user_db.update(
+            uuid=self.user.uuid, password=new_hash, delta_balance=delta_balance
+        )
+
+        updated_user = self.user_db.read(uuid=self.user.uuid)
+        self.assertIsNotNone(updated_user)
+        if updated_user is not None:
+            self.assertEqual(updated_user.password, new_hash)
+            self.assertEqual(updated_user.balance, delta_balance)
+
+    def test_balance_update_overflow(self):
+        self.user_db.update(uuid=self.user.uuid, delta_balance=MAX_BALANCE)
+
+        # The balance must stay an integer instead of becoming a REAL
+        with self.assertRaises(OverflowError):
+            self.user_db.update(uuid=self.user.uuid, delta_balance=1)
+
+        updated_user = self.user_db.read(uuid=self.user.uuid)
+        self.assertIsNotNone(updated_user)
+        if updated_user is not None:
+            self.assertEqual(updated_user.balance, MAX_BALANCE)
+            self.assertIsInstance(updated_user.balance, int)
+
+    def test_balance_update_of_nonexistent_user(self):
+        with self.assertRaises(NameError):
+            self.user_db.update(uuid="xxxx-xxxx-xxxx-xxxx", delta_balance=1)
+
+    def tearDown(self):
+        # The in-memory database is discarded when its connection closes
+        self.user_db.close()
+
+
+class TestDBMigration(unittest.TestCase):
+    """
+    Tests the migration of databases created by older versions.
+    """
+
+    def setUp(self):
+        self.path = Path("test_migration.db")
+
+        # Version 0 stored balances as REAL amounts
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                """
+                    CREATE TABLE bank (
+                        uuid TEXT PRIMARY KEY,
+                        username TEXT UNIQUE,
+                        hash TEXT,
+                        balance REAL
+                    );
+                """
+            )
+            connection.execute(
+                "INSERT INTO bank VALUES (?, ?, ?, ?)",
+                ("aaaa-aaaa-aaaa-aaaa", "test_user1", "hash", 1234.56),
+            )
+        connection.close()
+
+    def test_balance_migration_to_cents(self):
+        expected_balance = 123456
+
+        user_db = UserDatabase(self.path)
+        retrieved_user = user_db.read(uuid="aaaa-aaaa-aaaa-aaaa")
+
+        self.assertIsNotNone(retrieved_user)
+        if retrieved_user is not None:
+            self.assertEqual(retrieved_user.balance, expected_balance)
+            self.assertIsInstance(retrieved_user.balance, int)
+        user_db.close()
+
+    def test_table_rebuild_without_rowid(self):
+        user_db = UserDatabase(self.path)
+        user_db.close()
+
+        with sqlite3.connect(self.path) as connection:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            without_rowid = connection.execute(
+                "SELECT wr FROM pragma_table_list WHERE name = 'bank'"
+            ).fetchone()[0]
+        connection.close()
+
+        self.assertEqual(version, SCHEMA_VERSION)
+        self.assertEqual(without_rowid, 1)
+
+    def test_lookups_use_indexes(self):
+        user_db = UserDatabase(self.path)
+        user_db.close()
+
+        # Both lookups must search a B-tree instead of scanning the table
+        with sqlite3.connect(self.path) as connection:
+            plans = [
+                connection.execute(
+                    f"EXPLAIN QUERY PLAN SELECT * FROM bank WHERE {column} = ?",
+                    ("value",),
+                ).fetchone()[3]
+                for column in ("uuid", "username")
+            ]
+        connection.close()
+
+        for plan in plans:
+            self.assertTrue(plan.startswith("SEARCH"), plan)
+
     def tearDown(self):
-        # Clean up the database after tests
-        self.user_db.delete("aaaa-aaaa-aaaa-aaaa")
         remove(self.path)
 
 
+class TestAmounts(unittest.TestCase):
+    """
+    Tests the parsing and formatting of amounts of money.
+    """
+
+    def test_valid_amounts(self):
+        self.assertEqual(to_cents("5000"), 500000)
+        self.assertEqual(to_cents("12.34"), 1234)
+        self.assertEqual(to_cents("0.1"), 10)
+        self.assertEqual(to_cents("0"), 0)
+
+    def test_invalid_amounts(self):
+        for amount in ("", "abc", "-5", "1.234", "nan", "inf", "1e100", "1e999999"):
+            self.assertIsNone(to_cents(amount), amount)
+
+    def test_format_cents(self):
+        self.assertEqual(format_cents(500000), "5000.00")
+        self.assertEqual(format_cents(1234), "12.34")
+        self.assertEqual(format_cents(0), "0.00")
+
+
+class TestHasherCalibration(unittest.TestCase):
+    """
+    Tests the Argon2 parameters calibration.
+    """
+
+    def setUp(self):
+        self.path = Path("test_argon2.json")
+
+    def test_calibration_with_minimum_parameters(self):
+        hasher = calibrate_hasher(target_time=0.0, parallelism=1)
+
+        self.assertEqual(hasher.time_cost, ARGON2_MIN_TIME_COST)
+        self.assertEqual(hasher.memory_cost, ARGON2_MIN_MEMORY_COST)
+        self.assertEqual(hasher.parallelism, 1)
+
+    def test_calibration_is_persisted(self):
+        hasher = load_hasher(self.path)
+        self.assertTrue(self.path.is_file())
+
+        # A second load should read the stored parameters
+        stored_hasher = load_hasher(self.path)
+        self.assertEqual(stored_hasher.time_cost, hasher.time_cost)
+        self.assertEqual(stored_hasher.memory_cost, hasher.memory_cost)
+        self.assertEqual(stored_hasher.parallelism, hasher.parallelism)
+
+    def test_hashing_workers_leave_cpus_for_lanes(self):
+        cpus = cpu_count() or 1
+
+        # Hashes that use every CPU run one at a time
+        hasher = argon2.PasswordHasher(
+            time_cost=1, memory_cost=8 * cpus, parallelism=cpus
+        )
+        self.assertEqual(hashing_workers(hasher, 100), 1)
+
+        # Single lane hashes use one worker per CPU, but never more than jobs
+        self.assertEqual(hashing_workers(PH, 100), min(100, cpus))
+        self.assertEqual(hashing_workers(PH, 1), 1)
+
+    def tearDown(self):
+        # Clean up the stored parameters after tests
+        if self.path.is_file():
+            remove(self.path)
+
+
 class TestBankAuth(unittest.TestCase):
     """
     Tests the Bank class authentication.
     """
 
     def setUp(self):
-        self.path = Path("test.db")
-        self.bank = Bank(self.path)
+        self.path = Path(":memory:")
+        self.bank = Bank(self.path, hasher=PH)
         self.database = self.bank.get_db()
         self.users = [(f"test_user{i}", "password") for i in range(1, 2)]
-        self.uuids = []
-        for user in self.users:
-            self.bank.register(*user)
-            user_data = self.database.read(username=user[0])
-            if user_data is not None:
-                self.uuids.append(user_data.uuid)
+        self.uuids = [uuid for _, uuid in self.bank.register_many(self.users)]
 
     # Registration
     def test_user_registration_with_bad_args(self):
@@ -140,6 +348,42 @@ class TestBankAuth(unittest.TestCase):
         registration_error_code, _ = self.bank.register(*self.users[0])
         self.assertEqual(registration_error_code, expected_error_code)
 
+    def test_batch_user_registration(self):
+        expected_error_codes = [OK, INVALID_REGISTRATION, BAD_ARGUMENTS, OK]
+
+        credentials = [
+            ("test_user_batch1", "password"),
+            self.users[0],
+            ("test_user_batch2", ""),
+            ("test_user_batch3", "password"),
+        ]
+        registration_results = self.bank.register_many(credentials)
+        registration_error_codes = [
+            error_code for error_code, _ in registration_results
+        ]
+        self.assertEqual(registration_error_codes, expected_error_codes)
+
+        # Registered users should be able to login with the returned UUID
+        for index in (0, 3):
+            username, password = credentials[index]
+            login_error_code, uuid = self.bank.login(username, password)
+            self.assertEqual(login_error_code, OK)
+            self.assertEqual(uuid, registration_results[index][1])
+
+    def test_user_registration_of_concurrently_taken_username(self):
+        expected_error_code = INVALID_REGISTRATION
+
+        # Another registration takes the username after it was checked
+        with patch.object(self.database, "read_by_username", return_value=None):
+            registration_error_code, _ = self.bank.register(*self.users[0])
+            self.assertEqual(registration_error_code, expected_error_code)
+
+            registration_results = self.bank.register_many(
+                [self.users[0], ("test_user_batch1", "password")]
+            )
+        self.assertEqual(registration_results[0], (expected_error_code, ""))
+        self.assertEqual(registration_results[1][0], OK)
+
     # Logout
     def test_user_logout_with_bad_args(self):
         expected_error_code = BAD_ARGUMENTS
@@ -195,24 +439,189 @@ class TestBankAuth(unittest.TestCase):
         login_error_code, _ = self.bank.login(*self.users[0])
         self.assertEqual(login_error_code, expected_error_code)
 
+    def test_user_login_after_session_expiration(self):
+        expected_error_code = OK
+
+        # Sessions of this bank expire as soon as they are created
+        bank = Bank(self.path, session_ttl=0.0, hasher=PH)
+        bank.register(*self.users[0])
+        _, _ = bank.login(*self.users[0])
+
+        login_error_code, _ = bank.login(*self.users[0])
+        self.assertEqual(login_error_code, expected_error_code)
+
+        # Expired sessions can't be logged out
+        _, uuid = bank.login(*self.users[0])
+        logout_error_code, _ = bank.logout(uuid=uuid)
+        self.assertEqual(logout_error_code, UUID_NOT_FOUND)
+
+    def test_session_extended_by_touch(self):
+        expected_error_code = SESSION_CONFLICT
+
+        bank = Bank(self.path, session_ttl=0.2, hasher=PH)
+        bank.register(*self.users[0])
+        _, uuid = bank.login(*self.users[0], owner=1)
+
+        # A long-lived connection outlasts the TTL while it keeps sending commands
+        for _ in range(3):
+            sleep(0.1)
+            self.assertTrue(bank.touch(uuid, owner=1))
+
+        login_error_code, _ = bank.login(*self.users[0], owner=2)
+        self.assertEqual(login_error_code, expected_error_code)
+
+    def test_expired_owner_keeps_later_session(self):
+        expected_error_code = SESSION_CONFLICT
+
+        bank = Bank(self.path, session_ttl=0.2, hasher=PH)
+        bank.register(*self.users[0])
+        _, uuid = bank.login(*self.users[0], owner=1)
+
+        # The first session expires and a second connection logs in
+        sleep(0.3)
+        login_error_code, _ = bank.login(*self.users[0], owner=2)
+        self.assertEqual(login_error_code, OK)
+
+        # The first connection can neither extend nor end the new session
+        self.assertFalse(bank.touch(uuid, owner=1))
+        logout_error_code, _ = bank.logout(uuid=uuid, owner=1)
+        self.assertEqual(logout_error_code, UUID_NOT_FOUND)
+
+        login_error_code, _ = bank.login(*self.users[0], owner=3)
+        self.assertEqual(login_error_code, expected_error_code)
+
+        logout_error_code, _ = bank.logout(uuid=uuid, owner=2)
+        self.assertEqual(logout_error_code, OK)
+
     def test_user_login_with_correct_password(self):
         expected_error_code = OK
 
         login_error_code, _ = self.bank.login(*self.users[0])
         self.assertEqual(login_error_code, expected_error_code)
 
+    def test_user_login_rehashes_outdated_password(self):
+        expected_error_code = OK
+
+        # Store a hash made with parameters other than the ones of the bank
+        old_hasher = argon2.PasswordHasher(time_cost=2, memory_cost=8, parallelism=1)
+        uuid = self.uuids[0]
+        username, password = self.users[0]
+        self.database.update(uuid=uuid, password=old_hasher.hash(password))
+
+        login_error_code, _ = self.bank.login(username, password)
+        self.assertEqual(login_error_code, expected_error_code)
+
+        user_data = self.database.read(uuid=uuid)
+        self.assertIsNotNone(user_data)
+        if user_data is not None:
+            self.assertFalse(PH.check_needs_rehash(user_data.password))
+            self.assertTrue(PH.verify(user_data.password, password))
+
+    def test_user_login_rehash_keeps_concurrent_password_change(self):
+        uuid = self.uuids[0]
+        username, password = self.users[0]
+        new_hash = PH.hash("new_password")
+
+        # The password changes between the verification and the rehash
+        def change_password_then_rehash(hasher, hash):
+            self.database.update(uuid=uuid, password=new_hash)
+            return True
+
+        with patch.object(
+            argon2.PasswordHasher,
+            "check_needs_rehash",
+            autospec=True,
+            side_effect=change_password_then_rehash,
+        ):
+            _, uuid = self.bank.login(username, password)
+        self.bank.logout(uuid=uuid)
+
+        # So the rehash of the old password must not overwrite it
+        user_data = self.database.read(uuid=uuid)
+        self.assertIsNotNone(user_data)
+        if user_data is not None:
+            self.assertEqual(user_data.password, new_hash)
+
+    def test_login_index_drops_least_recent_user(self):
+        expected_error_code = OK
+
+        username, password = self.users[0]
+        self.bank.register("test_user_index", "password")
+
+        # With room for a single user, the second login evicts the first one
+        with patch("src.bank.LOGIN_INDEX_SIZE", 1):
+            _, uuid = self.bank.login(username, password)
+            self.bank.logout(uuid=uuid)
+            _, other_uuid = self.bank.login("test_user_index", "password")
+            self.bank.logout(uuid=other_uuid)
+
+        # So the first user credentials are read again from the database
+        self.database.update(uuid=uuid, password=PH.hash("new_password"))
+        login_error_code, _ = self.bank.login(username, "new_password")
+        self.assertEqual(login_error_code, expected_error_code)
+
+    def test_login_index_skips_hash_read_before_password_change(self):
+        expected_error_code = INVALID_LOGIN
+
+        uuid = self.uuids[0]
+        username, old_password = self.users[0]
+        read_by_username = self.database.read_by_username
+
+        # The password changes right after the login read the old hash
+        def read_then_change_password(username):
+            user_data = read_by_username(username)
+            self.bank.change_password(
+                uuid=uuid, old_password=old_password, new_password="new_password"
+            )
+            return user_data
+
+        with patch.object(
+            self.database, "read_by_username", side_effect=read_then_change_password
+        ):
+            _, uuid = self.bank.login(username, old_password)
+        self.bank.logout(uuid=uuid)
+
+        # So the old hash must not be left in the index
+        login_error_code, _ = self.bank.login(username, old_password)
+        self.assertEqual(login_error_code, expected_error_code)
+        login_error_code, _ = self.bank.login(username, "new_password")
+        self.assertEqual(login_error_code, OK)
+
     # Change password
     def test_change_password_correctly(self):
-        pass
+        expected_error_code = OK
+
+        username, old_password = self.users[0]
+        new_password = "new_password"
+
+        # Change password while logged in
+        _, uuid = self.bank.login(username, old_password)
+        change_error_code, _ = self.bank.change_password(
+            uuid=uuid, old_password=old_password, new_password=new_password
+        )
+        self.assertEqual(change_error_code, expected_error_code)
+
+        # Login again using the new password
+        self.bank.logout(uuid=uuid)
+        login_error_code, _ = self.bank.login(username, new_password)
+        self.assertEqual(login_error_code, expected_error_code)
 
     def test_change_password_failure(self):
-        pass
+        expected_error_code = INVALID_LOGIN
+
+        uuid = self.uuids[0]
+        change_error_code, _ = self.bank.change_password(
+            uuid=uuid, old_password="wrong_password", new_password="new_password"
+        )
+        self.assertEqual(change_error_code, expected_error_code)
+
+        # Old password should still be valid
+        login_error_code, _ = self.bank.login(*self.users[0])
+        self.assertEqual(login_error_code, OK)
 
     def tearDown(self):
-        # Clean up the database after tests
-        for uuid in self.uuids:
-            self.database.delete(uuid)
-        remove(self.path)
+        # The in-memory database is discarded when its connection closes
+        self.database.close()
 
 
 class TestBankTransactions(unittest.TestCase):
@@ -221,16 +630,11 @@ class TestBankTransactions(unittest.TestCase):
     """
 
     def setUp(self):
-        self.path = Path("test.db")
-        self.bank = Bank(self.path)
+        self.path = Path(":memory:")
+        self.bank = Bank(self.path, hasher=PH)
         self.database = self.bank.get_db()
         self.users = [(f"test_user{i}", "password") for i in range(1, 3)]
-        self.uuids = []
-        for user in self.users:
-            self.bank.register(*user)
-            user_data = self.database.read(username=user[0])
-            if user_data is not None:
-                self.uuids.append(user_data.uuid)
+        self.uuids = [uuid for _, uuid in self.bank.register_many(self.users)]
 
     # Balance
     def test_balance_with_bad_arguments(self):
@@ -280,11 +684,53 @@ class TestBankTransactions(unittest.TestCase):
         # Error 0 is no error
         self.assertEqual(deposit_error_code, expected_error_code)
 
-        # Check if expected_balance matches delta balance, because initial is 0.0
-        new_balance = float(self.bank.balance(uuid=uuid)[1])
-        expected_balance = delta_balance
+        # Check if expected_balance matches delta balance, because initial is 0
+        new_balance = to_cents(self.bank.balance(uuid=uuid)[1])
+        expected_balance = to_cents(str(delta_balance))
         self.assertEqual(new_balance, expected_balance)
 
+    def test_deposit_with_invalid_amount(self):
+        expected_error_code = BAD_ARGUMENTS
+
+        uuid = self.uuids[0]
+        for amount in ("abc", "-5000", "0.001"):
+            deposit_error_code, _ = self.bank.deposit(uuid=uuid, amount=amount)
+            self.assertEqual(deposit_error_code, expected_error_code)
+
+        # Confirm unaffected balance
+        _, balance = self.bank.balance(uuid=uuid)
+        self.assertEqual(balance, "0.00")
+
+    def test_deposit_over_maximum_balance(self):
+        expected_error_code = BAD_ARGUMENTS
+
+        uuid = self.uuids[0]
+        max_amount = format_cents(MAX_BALANCE)
+        deposit_error_code, _ = self.bank.deposit(uuid=uuid, amount=max_amount)
+        self.assertEqual(deposit_error_code, OK)
+
+        deposit_error_code, _ = self.bank.deposit(uuid=uuid, amount=max_amount)
+        self.assertEqual(deposit_error_code, expected_error_code)
+
+        # Confirm unaffected balance
+        _, balance = self.bank.balance(uuid=uuid)
+        self.assertEqual(balance, max_amount)
+
+    def test_deposit_to_nonexistent_user(self):
+        expected_error_code = UUID_NOT_FOUND
+
+        deposit_error_code, _ = self.bank.deposit(uuid="xxxx", amount="1")
+        self.assertEqual(deposit_error_code, expected_error_code)
+
+    def test_deposit_with_cents(self):
+        uuid = self.uuids[0]
+        self.bank.deposit(uuid=uuid, amount="0.1")
+        self.bank.deposit(uuid=uuid, amount="0.2")
+
+        # Amounts are exact, unlike 0.1 + 0.2 with floats
+        _, balance = self.bank.balance(uuid=uuid)
+        self.assertEqual(balance, "0.30")
+
     # Withdraw
     def test_withdraw_with_bad_args(self):
         expected_error_code = BAD_ARGUMENTS
@@ -323,7 +769,7 @@ class TestBankTransactions(unittest.TestCase):
         uuid = self.uuids[0]
         deposit_amount = 5000
         self.bank.deposit(uuid=uuid, amount=str(deposit_amount))
-        old_balance = float(self.bank.balance(uuid=uuid)[1])
+        old_balance = to_cents(self.bank.balance(uuid=uuid)[1])
 
         # Withdraw from account
         withdraw_amount = 3000
@@ -333,10 +779,37 @@ class TestBankTransactions(unittest.TestCase):
         self.assertEqual(withdraw_error_code, expected_error_code)
 
         # Confirm new balance, and succesful withdrawal
-        expected_balance = old_balance - withdraw_amount
-        new_balance = float(self.bank.balance(uuid=uuid)[1])
+        expected_balance = old_balance - to_cents(str(withdraw_amount))
+        new_balance = to_cents(self.bank.balance(uuid=uuid)[1])
         self.assertEqual(new_balance, expected_balance)
 
+    def test_concurrent_withdrawals(self):
+        uuid = self.uuids[0]
+        self.bank.deposit(uuid=uuid, amount="5")
+
+        # Every thread withdraws at the same time, only 5 of them can afford it
+        threads_number = 16
+        barrier = Barrier(threads_number)
+        results = []
+
+        def withdraw():
+            barrier.wait()
+            results.append(self.bank.withdraw(uuid=uuid, amount="1")[0])
+
+        threads = [Thread(target=withdraw) for _ in range(threads_number)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(OK), 5)
+        self.assertEqual(results.count(INSUFFICIENT_FUNDS), threads_number - 5)
+        self.assertEqual(self.bank.balance(uuid=uuid)[1], "0.00")
+
+    def test_withdraw_from_nonexistent_user(self):
+        withdraw_error_code, _ = self.bank.withdraw(uuid="xxxx", amount="1")
+        self.assertEqual(withdraw_error_code, UUID_NOT_FOUND)
+
     # Transfer
     def test_transfer_with_bad_args(self):
         expected_error_code = BAD_ARGUMENTS
@@ -381,6 +854,83 @@ class TestBankTransactions(unittest.TestCase):
         )
         self.assertEqual(transfer_error_code, expected_error_code)
 
+    def test_transfer_with_not_enough_balance(self):
+        expected_error_code = INSUFFICIENT_FUNDS
+
+        uuid1, uuid2 = self.uuids
+        old_balance1 = self.bank.balance(uuid=uuid1)[1]
+        old_balance2 = self.bank.balance(uuid=uuid2)[1]
+
+        transfer_amount = 5000
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid1, receiver_uuid=uuid2, amount=str(transfer_amount)
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+
+        # Confirm both balances are unaffected
+        self.assertEqual(self.bank.balance(uuid=uuid1)[1], old_balance1)
+        self.assertEqual(self.bank.balance(uuid=uuid2)[1], old_balance2)
+
+    def test_transfer_without_moving_funds(self):
+        expected_error_code = OK
+
+        uuid1, uuid2 = self.uuids
+        self.bank.deposit(uuid=uuid1, amount="5000")
+
+        # Zero amount transfer
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid1, receiver_uuid=uuid2, amount="0"
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+
+        # Transfer to itself
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid1, receiver_uuid=uuid1, amount="5000"
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+
+        # Confirm unaffected balances
+        self.assertEqual(self.bank.balance(uuid=uuid1)[1], "5000.00")
+        self.assertEqual(self.bank.balance(uuid=uuid2)[1], "0.00")
+
+    def test_transfer_without_moving_funds_of_non_existent_user(self):
+        expected_error_code = UUID_NOT_FOUND
+
+        uuid1 = self.uuids[0]
+        uuid2 = "this-is-clearly-not-a-valid-uuid"
+
+        # Zero amount transfer, from and to a non existent user
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid2, receiver_uuid=uuid1, amount="0"
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid1, receiver_uuid=uuid2, amount="0"
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+
+        # Transfer of a non existent user to itself
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid2, receiver_uuid=uuid2, amount="5000"
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+
+    def test_transfer_over_maximum_balance(self):
+        expected_error_code = BAD_ARGUMENTS
+
+        uuid1, uuid2 = self.uuids
+        self.bank.deposit(uuid=uuid1, amount="1")
+        self.bank.deposit(uuid=uuid2, amount=format_cents(MAX_BALANCE))
+
+        transfer_error_code, _ = self.bank.transfer(
+            sender_uuid=uuid1, receiver_uuid=uuid2, amount="1"
+        )
+        self.assertEqual(transfer_error_code, expected_error_code)
+
+        # Confirm unaffected balances
+        self.assertEqual(self.bank.balance(uuid=uuid1)[1], "1.00")
+        self.assertEqual(self.bank.balance(uuid=uuid2)[1], format_cents(MAX_BALANCE))
+
     def test_transfer_to_existent_user(self):
         expected_error_code = OK
 
@@ -389,8 +939,8 @@ class TestBankTransactions(unittest.TestCase):
         self.bank.deposit(uuid=uuid1, amount=str(deposit_amount))
 
         # Check balance before transfer
-        old_balance1 = float(self.bank.balance(uuid=uuid1)[1])
-        old_balance2 = float(self.bank.balance(uuid=uuid2)[1])
+        old_balance1 = to_cents(self.bank.balance(uuid=uuid1)[1])
+        old_balance2 = to_cents(self.bank.balance(uuid=uuid2)[1])
 
         transfer_amount = deposit_amount
         transfer_error_code, _ = self.bank.transfer(
@@ -399,52 +949,141 @@ class TestBankTransactions(unittest.TestCase):
         self.assertEqual(transfer_error_code, expected_error_code)
 
         # Confirm new balances, and succesful transfer
-        new_balance1 = float(self.bank.balance(uuid=uuid1)[1])
-        new_balance2 = float(self.bank.balance(uuid=uuid2)[1])
-        expected_balance1 = old_balance1 - transfer_amount
-        expected_balance2 = old_balance2 + transfer_amount
+        new_balance1 = to_cents(self.bank.balance(uuid=uuid1)[1])
+        new_balance2 = to_cents(self.bank.balance(uuid=uuid2)[1])
+        expected_balance1 = old_balance1 - to_cents(str(transfer_amount))
+        expected_balance2 = old_balance2 + to_cents(str(transfer_amount))
 
         self.assertEqual(new_balance1, expected_balance1)
         self.assertEqual(new_balance2, expected_balance2)
 
     def tearDown(self):
-        # Clean up the database after tests
-        for uuid in self.uuids:
-            self.database.delete(uuid)
-
-    # class TestServer(unittest.TestCase):
-    #     """
-    #     Tests the bank server.
-    #     """
-    #
-    #     def setUp(self):
-    #         self.server_address = ("localhost", 55555)
-    #         self.server = Server(
-    #             server_address=self.server_address,
-    #             dbpath=Path("tests/test.db"),
-    #             certfile=Path("tests/test.crt"),
-    #             keyfile=Path("tests/test.key"),
-    #             verbose=True,
-    #         )
-    #
-    #         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    #         self.context.load_verify_locations("tests/test.crt")
-    #         self.server.tcp_thread.start()
-    #
-    #     async def test_client_ssl_connection(self):
-    #         expected_response = "OK bank"
-    #         message = "HI"
-    #         with socket.create_connection(self.server_address) as sock:
-    #             with self.context.wrap_socket(
-    #                 sock, server_hostname=self.server_address[0]
-    #             ) as ssock:
-    #                 ssock.send(message.encode("utf-8"))
-    #                 res = ssock.recv(2048).decode()
-    #                 self.assertEqual(res, expected_response)
-    #
-    #     def tearDown(self):
-    #         self.server.tcp_server.shutdown()
-    #         self.server.tcp_thread.join()
+        # The in-memory database is discarded when its connection closes
+        self.database.close()
+
+
+CERTFILE = Path("tests/test.crt")
+KEYFILE = Path("tests/test.key")
+
+
+@unittest.skipUnless(
+    CERTFILE.is_file() and KEYFILE.is_file(),
+    "run tests/generate_test_certificates.sh inside tests/ first",
+)
+class TestServer(unittest.TestCase):
+    """
+    Tests the bank server.
+    """
+
+    def setUp(self):
+        self.bank = Bank(Path(":memory:"), session_ttl=0.5, hasher=PH)
+        self.server = BankTCPServer(
+            server_address=("localhost", 0),
+            handler=BankTCPServerHandler,
+            bank=self.bank,
+            certfile=CERTFILE,
+            keyfile=KEYFILE,
+            logger=setup_logger(name="server"),
+        )
+        self.server_address = self.server.server_address
+        self.server_thread = Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.context.load_verify_locations(CERTFILE)
+
+    def test_client_ssl_connection(self):
+        expected_response = b"OK bank\r\n"
+        message = b"HI\r\n"
+        with socket.create_connection(self.server_address) as sock:
+            with self.context.wrap_socket(sock, server_hostname="localhost") as ssock:
+                ssock.sendall(message)
+                response = ssock.recv(2048)
+                self.assertEqual(response, expected_response)
+
+    def connect(self) -> ssl.SSLSocket:
+        sock = socket.create_connection(self.server_address)
+        return self.context.wrap_socket(sock, server_hostname="localhost")
+
+    def send(self, ssock: ssl.SSLSocket, message: str) -> bytes:
+        ssock.sendall(f"{message}\r\n".encode("utf-8"))
+        return ssock.recv(2048)
+
+    def test_too_long_command(self):
+        expected_response = b"ERR 253\r\nOK bank\r\n"
+
+        # The end of an overlong line must not run as a command of its own
+        message = b"X" * (MAX_LINE_LENGTH * 4) + b"HI\r\nHI\r\n"
+        with self.connect() as ssock:
+            ssock.sendall(message)
+            response = b""
+            while response.count(b"\r\n") < 2:
+                data = ssock.recv(2048)
+                if not data:
+                    break
+                response += data
+            self.assertEqual(response, expected_response)
+
+    def test_long_lived_connection(self):
+        first = self.connect()
+        self.send(first, "REGISTER test_user1 password")
+        self.send(first, "LOGIN test_user1 password")
+
+        # Commands keep the session alive past its TTL
+        for _ in range(3):
+            sleep(0.25)
+            self.assertEqual(self.send(first, "BALANCE"), b"OK 0.00\r\n")
+
+        with self.connect() as second:
+            self.assertEqual(
+                self.send(second, "LOGIN test_user1 password"), b"ERR 3\r\n"
+            )
+
+        # Once idle past the TTL, another connection takes over the session
+        sleep(0.6)
+        second = self.connect()
+        self.assertTrue(
+            self.send(second, "LOGIN test_user1 password").startswith(b"OK")
+        )
+        self.assertEqual(self.send(first, "BALANCE"), b"ERR 251\r\n")
+
+        # Closing the first connection doesn't end the second session
+        first.close()
+        sleep(0.1)
+        with self.connect() as third:
+            self.assertEqual(
+                self.send(third, "LOGIN test_user1 password"), b"ERR 3\r\n"
+            )
+        second.close()
+
+    def test_login_with_too_many_sessions(self):
+        first = self.connect()
+        self.send(first, "REGISTER test_user1 password")
+        self.send(first, "REGISTER test_user2 password")
+
+        # With room for a single session, the second login is refused
+        with patch("src.server.MAX_SESSIONS", 1):
+            self.assertTrue(
+                self.send(first, "LOGIN test_user1 password").startswith(b"OK")
+            )
+            with self.connect() as second:
+                self.assertEqual(
+                    self.send(second, "LOGIN test_user2 password"), b"ERR 3\r\n"
+                )
+
+            # And its Bank session is ended, so it can log in elsewhere later
+            self.assertEqual(self.send(first, "LOGOUT"), b"OK \r\n")
+            with self.connect() as third:
+                self.assertTrue(
+                    self.send(third, "LOGIN test_user2 password").startswith(b"OK")
+                )
+        first.close()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        self.bank.get_db().close()
 
 
 if __name__ == "__main__":
@@ -1,13 +1,48 @@
-import socket
+import asyncio
 import ssl
+import sys
 
 hostname = "localhost"
 port = 55555
 context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
 context.load_verify_locations("./test.crt")
 
-with socket.create_connection((hostname, port)) as sock:
-    with context.wrap_socket(sock, server_hostname=hostname) as ssock:
-        while True:
-            ssock.send(input().encode("utf-8"))
-            print(ssock.recv(1024).decode())
+
+async def send_commands(writer: asyncio.StreamWriter, in_flight: asyncio.Queue):
+    # Commands are sent as soon as they are typed, without waiting for replies
+    loop = asyncio.get_running_loop()
+    while line := await loop.run_in_executor(None, sys.stdin.readline):
+        command = line.strip()
+        if not command:
+            continue
+
+        writer.write(f"{command}\r\n".encode("utf-8"))
+        await writer.drain()
+        in_flight.put_nowait(command)
+
+    # No more commands, the replies of the ones in flight are still printed
+    in_flight.put_nowait(None)
+
+
+async def print_replies(reader: asyncio.StreamReader, in_flight: asyncio.Queue):
+    # Every command gets a single CRLF terminated reply, in order
+    while await in_flight.get() is not None:
+        reply = await reader.readline()
+        if not reply:
+            return
+        print(reply.decode("utf-8").rstrip())
+
+
+async def main():
+    reader, writer = await asyncio.open_connection(
+        hostname, port, ssl=context, server_hostname=hostname
+    )
+    in_flight = asyncio.Queue()
+    await asyncio.gather(
+        send_commands(writer, in_flight), print_replies(reader, in_flight)
+    )
+    writer.close()
+    await writer.wait_closed()
+
+
+asyncio.run(main())